@@ -0,0 +1,100 @@
+"""
+Backends that perform the actual reboot.
+
+Every backend has a `reboot(delay)` method, which schedules the reboot in
+`delay` minutes and raises if that is not possible.
+"""
+import logging
+import subprocess
+import time
+
+LOG = logging.getLogger(__name__)
+
+KEXEC_KERNEL = "/boot/vmlinuz"
+KEXEC_INITRD = "/boot/initrd.img"
+
+
+def _run_delayed(command, delay):
+    """Run the command now, or in `delay` minutes with a transient systemd timer."""
+    if delay:
+        command = ["systemd-run", "--on-active=%im" % delay, "--timer-property=AccuracySec=1s"] + command
+    subprocess.run(command, check=True)
+
+
+class ShutdownBackend:
+    """Reboot with `shutdown -r`, which also warns logged in users."""
+
+    def reboot(self, delay):
+        subprocess.run(["shutdown", "-r", "+%i" % delay], check=True)
+
+
+class SystemctlBackend:
+    """Reboot with `systemctl reboot`."""
+
+    def reboot(self, delay):
+        _run_delayed(["systemctl", "reboot"], delay)
+
+
+class KexecBackend:
+    """
+    Start the newest installed kernel directly, skipping the firmware and
+    POST. Falls back to shutdown if the kernel cannot be loaded.
+    """
+
+    def __init__(self, kernel=KEXEC_KERNEL, initrd=KEXEC_INITRD):
+        self.kernel = kernel
+        self.initrd = initrd
+
+    def load(self) -> bool:
+        try:
+            subprocess.run(["kexec", "--load", self.kernel, "--initrd=" + self.initrd, "--reuse-cmdline"], check=True)
+            return True
+        except Exception as e:
+            LOG.warning("Could not load %s for kexec: %s", self.kernel, e)
+            return False
+
+    def reboot(self, delay):
+        if not self.load():
+            LOG.warning("Falling back to shutdown")
+            ShutdownBackend().reboot(delay)
+            return
+        _run_delayed(["systemctl", "kexec"], delay)
+
+
+class RecordingBackend:
+    """
+    Record reboots instead of rebooting.
+
+    The records are kept in the class, so tests and rolling reboot
+    simulations can run many invocations in one process and measure the
+    throughput without real machines.
+
+    It is not in BACKENDS, so that a node cannot be configured by mistake to
+    never reboot. Tests and simulations register it as "recorder".
+    """
+    # The node does not really reboot, so it keeps its boot id
+    simulated = True
+    reboots = []
+
+    def reboot(self, delay):
+        LOG.warning("Recording reboot in %i minutes instead of rebooting", delay)
+        RecordingBackend.reboots.append({"time": time.time(), "delay": delay})
+
+
+BACKENDS = {
+    "shutdown": ShutdownBackend,
+    "systemctl": SystemctlBackend,
+    "kexec": KexecBackend,
+}
+
+
+def is_simulated(name) -> bool:
+    """Whether the backend only pretends to reboot."""
+    return getattr(BACKENDS.get(name), "simulated", False)
+
+
+def get_backend(name):
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown reboot method: {name}")
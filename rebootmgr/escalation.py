@@ -0,0 +1,314 @@
+"""
+Escalation of failures and stop flag changes to chat and other sinks.
+
+Escalations are delivered from a background thread, so that a slow or
+failing sink never delays the reboot path (task timeouts, lock release).
+"""
+import datetime
+import hashlib
+import json
+import logging
+import queue
+import sys
+import syslog
+import threading
+import time
+
+import requests
+
+LOG = logging.getLogger(__name__)
+
+CHAT_ESCALATION_PREFIX = "service/rebootmgr/chat_escalations/"
+# Identical escalations of a group within this many seconds are merged
+CHAT_ESCALATION_WINDOW = 15 * 60
+
+# Job put into the queue to fire the summaries of expired windows
+_FLUSH = "flush"
+
+_QUEUE = None
+
+
+class ConsulEventSink:
+    """Fire the consul event `chat_escalation`, which is forwarded to chat."""
+    description = "chat_escalation event"
+
+    def __init__(self, con):
+        self.con = con
+
+    def deliver(self, escalation):
+        self.con.event.fire("chat_escalation", escalation["body"])
+
+
+class WebhookSink:
+    """POST the escalation as JSON to an URL."""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+        self.description = f"webhook {url}"
+
+    def deliver(self, escalation):
+        response = requests.post(self.url, json=escalation, timeout=self.timeout)
+        response.raise_for_status()
+
+
+class FileSink:
+    """Append the escalation as a JSON line to a local file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.description = f"file {path}"
+
+    def deliver(self, escalation):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(escalation) + "\n")
+
+
+class JournalSink:
+    """Log the escalation to syslog, which ends up in the journal."""
+    description = "journal"
+
+    def deliver(self, escalation):
+        syslog.openlog("rebootmgr")
+        syslog.syslog(syslog.LOG_WARNING, escalation["body"])
+
+
+class StdoutSink:
+    """Print the escalation as a JSON line."""
+    description = "stdout"
+
+    def deliver(self, escalation):
+        sys.stdout.write(json.dumps(escalation) + "\n")
+        sys.stdout.flush()
+
+
+def make_sink(con, spec):
+    """
+    Create a sink from its command line specification.
+
+    One of: consul, journal, stdout, file:PATH or webhook:URL
+    """
+    name, _, argument = spec.partition(":")
+    if name == "consul" and not argument:
+        return ConsulEventSink(con)
+    if name == "journal" and not argument:
+        return JournalSink()
+    if name == "stdout" and not argument:
+        return StdoutSink()
+    if name == "file" and argument:
+        return FileSink(argument)
+    if name == "webhook" and argument:
+        return WebhookSink(argument)
+    raise ValueError(f"Invalid escalation sink: {spec}")
+
+
+def chat_escalation_key(message, group=None):
+    """
+    Consul key of the rate-limit window for escalations with this message.
+
+    Escalations are deduplicated per group and message, so the hostname is
+    not part of the key.
+    """
+    digest = hashlib.sha1(message.encode()).hexdigest()[:16]
+    return f"{CHAT_ESCALATION_PREFIX}{group or '_global'}/{digest}"
+
+
+def make_escalation(hostname, message, group=None):
+    """Format: (hostname) (group) message"""
+    hostname_str = f"({hostname}) " if hostname else ""
+    group_str = f"({group}) " if group else ""
+    return {
+        "time": datetime.datetime.now().isoformat(),
+        "hostname": hostname,
+        "group": group,
+        "message": message,
+        "body": f"{hostname_str}{group_str}{message}",
+    }
+
+
+def _needs_summary(record) -> bool:
+    """Whether escalations were suppressed in the window that the first one did not report."""
+    if record["nodes"] == [""]:
+        # Escalations without a node, like the global stop flag, can only be counted
+        return record.get("count", 1) > 1
+    return len(record["nodes"]) > 1
+
+
+def _make_summary(record):
+    nodes = sorted(record["nodes"])
+    if nodes == [""]:
+        message = f"{record['message']} (repeated {record['count']} times)"
+    else:
+        shown = ", ".join(nodes[:10]) + (", ..." if len(nodes) > 10 else "")
+        message = f"{record['message']} (on {len(nodes)} nodes: {shown})"
+    return make_escalation(None, message, record.get("group"))
+
+
+class EscalationQueue:
+    """
+    Deduplicate escalations and deliver them to the sinks.
+
+    Every sink is tried `retries` more times with exponential backoff.
+    Once started, escalations are processed in a background thread; call
+    `close` to deliver the remaining ones before exiting.
+    """
+
+    def __init__(self, con, sinks, window=CHAT_ESCALATION_WINDOW, retries=3, backoff=2, maxsize=100):
+        self.con = con
+        self.sinks = sinks
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._run, name="escalation", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, job):
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            LOG.error("Escalation queue is full, dropping %s", job)
+
+    def close(self, timeout=60):
+        """Deliver the queued escalations, but wait no longer than `timeout` seconds."""
+        self.put(None)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            LOG.error("Could not deliver all escalations within %i seconds", timeout)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self.process(job)
+            except Exception as e:  # pragma: no cover
+                LOG.error("Failed to process escalation: %s", e)  # pragma: no cover
+
+    def process(self, job):
+        if job == _FLUSH:
+            for summary in self._flush():
+                self._deliver(summary)
+            return
+
+        if self.window:
+            try:
+                suppress, summary = self._record(job)
+                if summary:
+                    self._deliver(summary)
+                if suppress:
+                    LOG.info("Escalation was already fired in the last %i seconds, suppressing it", self.window)
+                    return
+            except Exception as e:
+                LOG.warning("Could not deduplicate chat escalation: %s", e)
+        self._deliver(job)
+
+    def _deliver(self, escalation):
+        for sink in self.sinks:
+            for attempt in range(self.retries + 1):
+                try:
+                    sink.deliver(escalation)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        LOG.error("Failed to fire %s: %s", sink.description, e)
+                    else:
+                        time.sleep(self.backoff * 2 ** attempt)
+
+    def _record(self, escalation):
+        """
+        Record the escalation in its cluster-wide rate-limit window.
+
+        Returns whether the same escalation was already fired for this group
+        within the window, so that it must be suppressed, and the summary of
+        the previous window if this escalation opened a new one.
+        """
+        key = chat_escalation_key(escalation["message"], escalation["group"])
+        hostname = escalation["hostname"] or ""
+        for _ in range(5):
+            now = time.time()
+            # A stale record would only make the check-and-set fail
+            _, item = self.con.kv.get(key, consistency="default")
+            record = json.loads(item["Value"].decode()) if item and item.get("Value") else None
+            expired = None
+
+            if record and now - record["since"] < self.window:
+                # Repeats of a node are dropped, repeats without a node are counted
+                if hostname and hostname in record["nodes"]:
+                    return True, None
+                if hostname not in record["nodes"]:
+                    record["nodes"].append(hostname)
+                record["count"] = record.get("count", 1) + 1
+                suppress = True
+            else:
+                expired = record
+                record = {"group": escalation["group"], "message": escalation["message"], "since": now,
+                          "nodes": [hostname], "count": 1}
+                suppress = False
+
+            if self.con.kv.put(key, json.dumps(record), cas=item["ModifyIndex"] if item else 0):
+                if expired and _needs_summary(expired):
+                    return suppress, _make_summary(expired)
+                return suppress, None
+        raise RuntimeError("Too many concurrent updates of %s" % key)
+
+    def _flush(self):
+        """
+        Remove the rate-limit windows that are over and return their summaries.
+
+        Runs on every invocation, so a summary is not lost when no node reports
+        the same escalation again.
+        """
+        summaries = []
+        try:
+            _, items = self.con.kv.get(CHAT_ESCALATION_PREFIX, recurse=True)
+            now = time.time()
+            for item in items or []:
+                record = json.loads(item["Value"].decode())
+                if now - record["since"] < self.window:
+                    continue
+                if self.con.kv.delete(item["Key"], cas=item["ModifyIndex"]) and _needs_summary(record):
+                    summaries.append(_make_summary(record))
+        except Exception as e:
+            LOG.warning("Could not flush chat escalations: %s", e)
+        return summaries
+
+
+def start(con, sink_specs, **kwargs) -> EscalationQueue:
+    """Deliver all following escalations in the background to the given sinks."""
+    global _QUEUE
+    _QUEUE = EscalationQueue(con, [make_sink(con, spec) for spec in sink_specs], **kwargs)
+    _QUEUE.start()
+    return _QUEUE
+
+
+def stop(timeout=60):
+    """Deliver the remaining escalations and go back to synchronous delivery."""
+    global _QUEUE
+    if _QUEUE:
+        _QUEUE.close(timeout)
+        _QUEUE = None
+
+
+def escalate(con, hostname, message, group=None):
+    """
+    Escalate a message to the configured sinks.
+
+    Without a started queue, it is fired synchronously as consul event.
+    """
+    escalation = make_escalation(hostname, message, group)
+    if _QUEUE:
+        _QUEUE.put(escalation)
+    else:
+        EscalationQueue(con, [ConsulEventSink(con)]).process(escalation)
+
+
+def flush(con):
+    """Fire the summaries of rate-limit windows that are over."""
+    if _QUEUE:
+        _QUEUE.put(_FLUSH)
+    else:
+        EscalationQueue(con, [ConsulEventSink(con)]).process(_FLUSH)
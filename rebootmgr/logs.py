@@ -0,0 +1,98 @@
+"""
+Context of a run for the logs, and the JSON log format.
+
+Every log record gets the run id, hostname, group, phase, elapsed time and
+exit code of the run, so that a log pipeline can follow a run and compute
+the duration of the phases across many nodes.
+"""
+import datetime
+import functools
+import json
+import logging
+import time
+import uuid
+
+LOG = logging.getLogger(__name__)
+
+
+class RunContext:
+    """State of the current run, added to every log record."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, hostname=None, group=None):
+        self.run_id = uuid.uuid4().hex
+        self.hostname = hostname
+        self.group = group
+        self.phase = "startup"
+        self.started = time.monotonic()
+        self.phase_started = self.started
+        self.exit_code = None
+
+    def elapsed_ms(self, since=None) -> int:
+        return int((time.monotonic() - (since or self.started)) * 1000)
+
+
+RUN = RunContext()
+
+
+def set_phase(phase):
+    """Start the next phase and log how long the previous one took."""
+    duration = RUN.elapsed_ms(RUN.phase_started)
+    LOG.debug("Phase %s took %i ms", RUN.phase, duration, extra={"phase_ms": duration})
+    RUN.phase = phase
+    RUN.phase_started = time.monotonic()
+
+
+def log_exit_code(func):
+    """Record and log the exit code of the command."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            result = func(*args, **kwargs)
+            RUN.exit_code = 0
+            return result
+        except SystemExit as e:
+            RUN.exit_code = e.code or 0
+            raise
+        except Exception:
+            RUN.exit_code = 1
+            raise
+        finally:
+            duration = RUN.elapsed_ms(RUN.phase_started)
+            LOG.debug("Exit with code %s in phase %s after %i ms", RUN.exit_code, RUN.phase, RUN.elapsed_ms(),
+                      extra={"phase_ms": duration})
+    return wrapper
+
+
+class ContextFilter(logging.Filter):
+    """Add the context of the run to every record."""
+
+    def filter(self, record):
+        record.run_id = RUN.run_id
+        record.hostname = RUN.hostname
+        record.group = RUN.group
+        record.phase = RUN.phase
+        record.elapsed_ms = RUN.elapsed_ms()
+        record.exit_code = RUN.exit_code
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the context of the run."""
+    FIELDS = ("run_id", "hostname", "group", "phase", "elapsed_ms", "exit_code", "phase_ms")
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
@@ -1,24 +1,38 @@
 import os
+import base64
 import click
+import concurrent.futures
+import fnmatch
 import getpass
 import logging
 import socket
+import stat
 import sys
 import json
+import re
 import subprocess
+import threading
 import time
 import colorlog
 import holidays
 import datetime
 from typing import List
+from typing import Optional
 from typing import Tuple
 
-from retrying import retry
 from consul import Consul
+from consul.base import CB
+from consul.base import ClientError
 from consul_lib import Lock
 from consul_lib.services import get_local_checks, get_failed_cluster_checks
 from consul_lib.session import SessionRenewer
 
+from rebootmgr import backends
+from rebootmgr import escalation
+from rebootmgr import logs
+from rebootmgr import retries
+from rebootmgr import tracing
+
 LOG = logging.getLogger(__name__)
 
 EXIT_UNKNOWN_ERROR = 1
@@ -30,6 +44,7 @@ EXIT_CONSUL_LOCK_FAILED = 4
 EXIT_CONSUL_LOST_LOCK = 5
 EXIT_HOLIDAY = 6
 EXIT_STOP_FLAG_FAILED = 7
+EXIT_CONSUL_NOT_READY = 8
 
 # exit codes >= 100 are permanent
 EXIT_TASK_FAILED = 100
@@ -37,9 +52,20 @@ EXIT_NODE_DISABLED = 101
 EXIT_STOP_FLAG_SET = 102
 EXIT_DID_NOT_REALLY_REBOOT = 103
 EXIT_CONFIGURATION_IS_MISSING = 104
+EXIT_INVALID_TASKS = 105
+
+# Status of consul members (serf)
+MEMBER_ALIVE = 1
+MEMBER_STATUS = {0: "none", 1: "alive", 2: "leaving", 3: "left", 4: "failed"}
+
+# Only one watchdog per datacenter acts
+WATCHDOG_LOCK = "service/rebootmgr/watchdog"
 
+# Nodes with failing node checks that the health pre-check looks up one by one
+NODE_LOOKUP_LIMIT = 10
 
-def logsetup(verbosity):
+
+def logsetup(verbosity, log_format="text"):
     level = logging.WARNING
 
     if verbosity > 0:
@@ -47,9 +73,13 @@ def logsetup(verbosity):
     if verbosity > 1:
         level = logging.DEBUG
 
-    stderr_formatter = colorlog.ColoredFormatter("%(log_color)s%(name)s [%(levelname)s] %(message)s")
+    if log_format == "json":
+        stderr_formatter = logs.JsonFormatter()
+    else:
+        stderr_formatter = colorlog.ColoredFormatter("%(log_color)s%(name)s [%(levelname)s] %(message)s")
     stderr_handler = logging.StreamHandler()
     stderr_handler.setFormatter(stderr_formatter)
+    stderr_handler.addFilter(logs.ContextFilter())
 
     logging.basicConfig(handlers=[stderr_handler], level=level)
 
@@ -58,20 +88,16 @@ def logsetup(verbosity):
 
 
 def fire_chat_escalation(con, hostname, message, group=None):
-    """Fire a consul event to escalate a failure to chat.
+    """Escalate a failure to chat.
 
     Format: (hostname) (group) message
+
+    See rebootmgr.escalation for deduplication and the delivery to sinks.
     """
-    hostname_str = f"({hostname}) " if hostname else ""
-    group_str = f"({group}) " if group else ""
-    body = f"{hostname_str}{group_str}{message}"
-    try:
-        con.event.fire("chat_escalation", body)
-    except Exception as e:
-        LOG.error("Failed to fire chat_escalation event: %s", e)
+    escalation.escalate(con, hostname, message, group)
 
 
-def run_tasks(tasktype, con, hostname, dryrun, task_timeout, group):
+def run_tasks(tasktype, con, hostname, dryrun, task_timeout, group, watcher=None, rollback_dir=None):
     """
     run every script in /etc/rebootmgr/pre_boot_tasks or
     /etc/rebootmgr/post_boot_tasks
@@ -79,6 +105,10 @@ def run_tasks(tasktype, con, hostname, dryrun, task_timeout, group):
     tasktype is either pre_boot or post_boot
     dryrun If true the environment variable REBOOTMGR_DRY_RUN=1 is passed to
            the scripts
+    watcher If a StopFlagWatcher is given, the tasks are aborted as soon as a
+            stop flag is set
+    rollback_dir If a task fails or is aborted, the scripts with the same name
+                 in this directory are run for the tasks that already ran
     """
     group_key = resolve_group_key(con, group, hostname)
     LOG.info("Looking up group from hostname: %s", group_key)
@@ -86,66 +116,489 @@ def run_tasks(tasktype, con, hostname, dryrun, task_timeout, group):
     if dryrun:
         env["REBOOTMGR_DRY_RUN"] = "1"
 
-    for task in sorted(os.listdir("/etc/rebootmgr/%s_tasks/" % tasktype)):
-        task = os.path.join("/etc/rebootmgr/%s_tasks" % tasktype, task)
-        LOG.info("Run task %s" % task)
-        p = subprocess.Popen(task, env=env)
-        try:
-            ret = p.wait(timeout=(task_timeout * 60))
-        except subprocess.TimeoutExpired:
-            p.terminate()
+    tasks, problems = discover_tasks("/etc/rebootmgr/%s_tasks/" % tasktype)
+    if problems:
+        exit_invalid_tasks(con, hostname, group, problems)
+
+    finished = []
+    for task in tasks:
+        metadata = read_task_metadata(task)
+        timeout = metadata.get("timeout", task_timeout)
+        max_retries = metadata.get("retries", 0)
+        LOG.info("Run task %s", task)
+        for attempt in range(max_retries + 1):
             try:
-                p.wait(timeout=10)
+                with tracing.span("task", task=task, tasktype=tasktype, attempt=attempt) as span:
+                    ret = run_task(task_command(task, metadata), env, timeout, watcher)
+                    span.set_attribute("return_code", ret)
             except subprocess.TimeoutExpired:
-                p.kill()
-            message = "Could not finish task %s in %i minutes" % (task, task_timeout)
-            LOG.error("%s. Exit" % message)
-            LOG.error("Disable rebootmgr in consul for this node")
-            data = get_config(con, hostname)
-            data["enabled"] = False
-            data["message"] = message
-            put_config(con, hostname, data)
-            con.kv.delete(group_key)
-            fire_chat_escalation(con, hostname, message, resolve_group_name(con, group, hostname))
-            sys.exit(EXIT_TASK_FAILED)
+                message = "Could not finish task %s in %i minutes" % (task, timeout)
+                LOG.error("%s. Exit", message)
+                LOG.error("Disable rebootmgr in consul for this node")
+                update_config(con, hostname, lambda config: disable_node(config, message))
+                run_rollback_tasks(rollback_dir, finished, env, task_timeout)
+                con.kv.delete(group_key)
+                fire_chat_escalation(con, hostname, message, resolve_group_name(con, group, hostname))
+                sys.exit(EXIT_TASK_FAILED)
+            if watcher and watcher.stop_flag:
+                message = "Stop flag %s (%s scope) was set, aborted task %s" % (watcher.stop_flag + (task,))
+                LOG.error("%s. Exit", message)
+                # The aborted task may have done a part of its work
+                run_rollback_tasks(rollback_dir, finished + [task], env, task_timeout)
+                fire_chat_escalation(con, hostname, message, resolve_group_name(con, group, hostname))
+                sys.exit(EXIT_STOP_FLAG_SET)
+            if ret == 0 or attempt == max_retries:
+                break
+            delay = metadata.get("backoff", 10) * 2 ** attempt
+            LOG.warning("Task %s failed with return code %s, retry in %i seconds", task, ret, delay)
+            time.sleep(delay)
         if ret != 0:
             message = "Task %s failed with return code %s" % (task, ret)
-            LOG.error("%s. Exit" % message)
+            LOG.error("%s. Exit", message)
+            run_rollback_tasks(rollback_dir, finished, env, task_timeout)
             fire_chat_escalation(con, hostname, message, resolve_group_name(con, group, hostname))
             sys.exit(EXIT_TASK_FAILED)
-        LOG.info("task %s finished" % task)
+        finished.append(task)
+        LOG.info("task %s finished", task)
+
+
+# Tasks of each directory as (mtime of the directory, tasks, problems)
+_TASKS = {}
+
+
+def validate_task(task) -> Optional[str]:
+    """Return what is wrong with the task, or None if it can run."""
+    if not os.path.isfile(task):
+        return "%s is not a file or a broken symlink" % task
+    st = os.stat(task)
+    if not os.access(task, os.X_OK):
+        return "%s is not executable" % task
+    if st.st_uid not in (0, os.geteuid()):
+        return "%s is owned by uid %i instead of root" % (task, st.st_uid)
+    if st.st_mode & stat.S_IWOTH:
+        return "%s is writable by everyone" % task
+    with open(task, "rb") as f:
+        head = f.read(4)
+    if not head.startswith(b"#!") and head != b"\x7fELF":
+        return "%s has no shebang and is not a binary" % task
+    return None
+
+
+def discover_tasks(directory) -> Tuple[List[str], List[str]]:
+    """
+    Return the tasks in the directory in the order they run, and the
+    problems of invalid tasks.
+
+    The result is cached until the mtime of the directory changes, so the
+    tasks are validated only once per run.
+    """
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        mtime = None
+    cached = _TASKS.get(directory)
+    if cached and mtime is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    tasks = [os.path.join(directory, name) for name in sorted(os.listdir(directory))]
+    problems = [problem for problem in map(validate_task, tasks) if problem]
+    if mtime is not None:
+        _TASKS[directory] = (mtime, tasks, problems)
+    return tasks, problems
+
+
+def check_tasks(con, hostname, group, directories):
+    """
+    Validate the tasks at startup, so that invalid tasks fail before
+    acquiring the lock. Missing directories fail only when their tasks run.
+    """
+    problems = []
+    for directory in directories:
+        try:
+            problems += discover_tasks(directory)[1]
+        except FileNotFoundError:
+            LOG.debug("Task directory %s does not exist", directory)
+    if problems:
+        exit_invalid_tasks(con, hostname, group, problems)
+
+
+def task_directories(reboot_in_progress, hostname, rollback_dir) -> list:
+    """
+    The task directories the run will use. After the reboot of this node,
+    only the post boot tasks are left, so other invalid tasks must not keep
+    the group locked.
+    """
+    if reboot_in_progress and parse_reboot_in_progress(reboot_in_progress)["host"] == hostname:
+        return ["/etc/rebootmgr/post_boot_tasks/"]
+    return ["/etc/rebootmgr/pre_boot_tasks/", "/etc/rebootmgr/post_boot_tasks/", rollback_dir]
+
+
+def exit_invalid_tasks(con, hostname, group, problems):
+    for problem in problems:
+        LOG.error("Invalid task: %s", problem)
+    message = "Invalid tasks: %s" % ", ".join(problems)
+    fire_chat_escalation(con, hostname, message, resolve_group_name(con, group, hostname))
+    sys.exit(EXIT_INVALID_TASKS)
+
+
+def run_task(command, env, timeout, watcher=None) -> int:
+    """
+    Run a task and return its exit code. If it does not finish within
+    timeout minutes, it is terminated (or killed) and TimeoutExpired raised.
+    """
+    p = subprocess.Popen(command, env=env)
+    if watcher:
+        watcher.set_process(p)
+    try:
+        return p.wait(timeout=(timeout * 60))
+    except subprocess.TimeoutExpired:
+        p.terminate()
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+        raise
+    finally:
+        if watcher:
+            watcher.set_process(None)
+
+
+# Task settings with integer values; timeout in minutes, backoff in seconds
+TASK_INT_SETTINGS = ("timeout", "retries", "backoff", "nice")
+# Smallest valid values of the integer settings, 0 if not listed
+TASK_INT_MINIMUM = {"timeout": 1}
+# Task settings that are limits of the systemd scope the task runs in
+TASK_SCOPE_PROPERTIES = {"cpu_quota": "CPUQuota", "memory_max": "MemoryMax", "io_weight": "IOWeight"}
+
+
+def read_task_metadata(task) -> dict:
+    """
+    Read the settings of a task from the comments in its first lines, like
+
+        # rebootmgr: timeout=30 retries=2 backoff=10
+        # rebootmgr: cpu_quota=50% memory_max=1G io_weight=50 nice=10
+
+    Unknown or malformed settings are ignored with a warning.
+    """
+    metadata = {}
+    try:
+        with open(task, errors="replace") as f:
+            lines = [line for _, line in zip(range(20), f)]
+    except (OSError, ValueError):
+        return metadata
+
+    for line in lines:
+        if not line.startswith("# rebootmgr:"):
+            continue
+        for setting in line[len("# rebootmgr:"):].replace(",", " ").split():
+            name, _, value = setting.partition("=")
+            if name in TASK_INT_SETTINGS and value.isdigit() and int(value) >= TASK_INT_MINIMUM.get(name, 0):
+                metadata[name] = int(value)
+            elif name in TASK_SCOPE_PROPERTIES and value:
+                metadata[name] = value
+            else:
+                LOG.warning("Ignoring invalid setting %s of task %s", setting, task)
+    return metadata
+
+
+def task_command(task, metadata):
+    """The command that runs the task with its resource limits."""
+    properties = ["--property=%s=%s" % (TASK_SCOPE_PROPERTIES[name], metadata[name])
+                  for name in sorted(TASK_SCOPE_PROPERTIES) if name in metadata]
+    if properties:
+        nice = ["--nice=%i" % metadata["nice"]] if "nice" in metadata else []
+        return ["systemd-run", "--scope", "--quiet", "--collect"] + properties + nice + [task]
+    if "nice" in metadata:
+        return ["nice", "-n", str(metadata["nice"]), task]
+    return task
+
+
+def run_rollback_tasks(rollback_dir, tasks, env, task_timeout):
+    """
+    Undo the given tasks in reverse order, with the scripts of the same name
+    in rollback_dir. Tasks without such a script are skipped.
+
+    Failing rollback tasks are only logged, so the others still run.
+    """
+    try:
+        rollback_tasks = set(map(os.path.basename, discover_tasks(rollback_dir)[0])) if rollback_dir else set()
+    except FileNotFoundError:
+        return
+    for task in reversed(tasks):
+        if os.path.basename(task) not in rollback_tasks:
+            continue
+        rollback_task = os.path.join(rollback_dir, os.path.basename(task))
+        LOG.info("Run rollback task %s", rollback_task)
+        try:
+            with tracing.span("rollback_task", task=rollback_task):
+                ret = run_task(rollback_task, env, task_timeout)
+            if ret != 0:
+                LOG.error("Rollback task %s failed with return code %s", rollback_task, ret)
+        except subprocess.TimeoutExpired:
+            LOG.error("Could not finish rollback task %s in %i minutes", rollback_task, task_timeout)
+        except Exception as e:
+            LOG.error("Could not run rollback task %s: %s", rollback_task, e)
+
+
+class StopFlagWatcher(threading.Thread):
+    """
+    Watch the stop flags while tasks run, and terminate the running task as
+    soon as one is set, instead of noticing it after the tasks.
+
+    A blocking query on the keys of service/rebootmgr/ returns on every
+    change below it, then the stop flags are checked with check_stop_flag.
+    """
+
+    def __init__(self, con, group, hostname, wait="10s", kill_after=30):
+        super().__init__(name="stop-flag-watcher", daemon=True)
+        self.con = con
+        self.group = group
+        self.hostname = hostname
+        self.wait = wait
+        self.kill_after = kill_after
+        # (key, scope) of the stop flag, once one is set
+        self.stop_flag = None
+        self.process = None
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def set_process(self, process):
+        """Set the running task. If a stop flag is already set, it is terminated right away."""
+        with self._lock:
+            self.process = process
+            stopped = self.stop_flag
+        if process and stopped:
+            self._terminate(process)
+
+    def close(self):
+        self._closed.set()
+
+    def run(self):
+        # The watcher must not use up the retry budget of the lock and record reads
+        retries.use_own_budget()
+        index = None
+        while not self._closed.is_set():
+            try:
+                index, _ = self.con.kv.get("service/rebootmgr/", index=index, wait=self.wait, keys=True, separator="/")
+                if self._closed.is_set():
+                    return
+                must_stop, key, scope = check_stop_flag(self.con, self.group, self.hostname)
+            except Exception as e:
+                LOG.warning("Could not watch the stop flags: %s", e)
+                self._closed.wait(5)
+                continue
+            if must_stop:
+                LOG.error("Stop flag is set (%s, %s scope), terminating the running task", key, scope)
+                with self._lock:
+                    self.stop_flag = (key, scope)
+                    process = self.process
+                if process:
+                    self._terminate(process)
+                return
+
+    def _terminate(self, process):
+        process.terminate()
+        try:
+            process.wait(timeout=self.kill_after)
+        except subprocess.TimeoutExpired:
+            LOG.error("Task did not terminate within %i seconds, killing it", self.kill_after)
+            process.kill()
+
+
+class Whitelist:
+    """
+    Hosts whose failed checks should be ignored.
+
+    Entries are hostnames, glob patterns ("compute-*"), regular expressions
+    ("re:ceph-[0-9]+") or groups ("group:ceph"); patterns must match the
+    whole hostname. Instead of a string, an entry can be an object with an
+    expiry date, after which it is ignored:
+    {"host": "compute-1", "expires": "2026-10-20T12:00:00"}
+    """
+
+    def __init__(self, entries, node_groups=None):
+        self.entries = []
+        self.hosts = set()
+        patterns = []
+        now = datetime.datetime.now()
+
+        for entry in entries:
+            if isinstance(entry, dict):
+                expires = _parse_expiry(entry.get("expires"))
+                if expires is not None and expires < now:
+                    LOG.info("Whitelist entry %s expired at %s, ignoring it", entry.get("host"), expires)
+                    continue
+                entry = entry.get("host")
+            if not isinstance(entry, str) or not entry:
+                LOG.warning("Ignoring malformed whitelist entry: %r", entry)
+                continue
+
+            if entry.startswith("group:"):
+                group = entry[len("group:"):]
+                self.hosts.update(node for node, g in (node_groups or {}).items() if g == group)
+            elif entry.startswith("re:"):
+                try:
+                    re.compile(entry[len("re:"):])
+                except re.error as e:
+                    LOG.warning("Ignoring invalid whitelist regular expression %s: %s", entry, e)
+                    continue
+                patterns.append(entry[len("re:"):])
+            elif any(c in entry for c in "*?["):
+                patterns.append(fnmatch.translate(entry))
+            else:
+                self.hosts.add(entry)
+            self.entries.append(entry)
+
+        # One compiled matcher for all patterns instead of a scan per host
+        self.pattern = re.compile("|".join("(?:%s)" % p for p in patterns)) if patterns else None
+
+    def __contains__(self, hostname):
+        if hostname in self.hosts:
+            return True
+        return bool(self.pattern and self.pattern.fullmatch(hostname))
+
+    def __bool__(self):
+        return bool(self.entries)
+
+    def __str__(self):
+        return ", ".join(self.entries)
+
+
+def _parse_expiry(expires):
+    """
+    Parse the expiry of a whitelist entry, which is either a unix timestamp
+    or a local date and time in ISO format.
+
+    Returns None if there is no expiry. Malformed dates are treated as
+    expired, so a typo does not ignore failed checks forever.
+    """
+    if expires is None:
+        return None
+    if isinstance(expires, (int, float)):
+        return datetime.datetime.fromtimestamp(expires)
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.datetime.strptime(expires, fmt)
+        except (TypeError, ValueError):
+            continue
+    LOG.warning("Malformed expiry date in whitelist: %r", expires)
+    return datetime.datetime.min
 
 
-def get_whitelist(con) -> List[str]:
+def get_whitelist(con) -> Whitelist:
     """
     Reads a list of hosts which should be ignored. May be absent.
+
+    It should be read once per run and passed to the checks.
     """
     k, v = con.kv.get("service/rebootmgr/ignore_failed_checks")
+    entries = []
     if v and "Value" in v.keys() and v["Value"]:
-        return json.loads(v["Value"].decode())
-    return []
+        entries = json.loads(v["Value"].decode())
+
+    node_groups = None
+    if any(isinstance(e, str) and e.startswith("group:") or
+           isinstance(e, dict) and str(e.get("host", "")).startswith("group:") for e in entries):
+        node_groups = get_all_node_groups(con)
+    return Whitelist(entries, node_groups)
+
+
+def get_relevant_services(con, tags: List[str]) -> dict:
+    """
+    Services of the local agent with one of the tags, with their tags.
+
+    This is answered by the local agent, not by the consul servers.
+    """
+    services = {}
+    for service in con.agent.services().values():
+        if set(service.get("Tags") or []) & set(tags):
+            services[service["Service"]] = service.get("Tags") or []
+    return services
+
+
+def get_unhealthy_checks(con, services) -> list:
+    """
+    Get the non-passing checks of the services and of the nodes.
+
+    The filter is evaluated by the consul servers, so only unhealthy checks
+    cross the wire instead of every check of every instance.
+    """
+    names = [""] + sorted(services)
+    expression = 'Status != "passing" and (%s)' % " or ".join("ServiceName == %s" % json.dumps(n) for n in names)
+
+    def callback(response):
+        LOG.debug("Filtered health query returned %i bytes", len(response.body))
+        return CB.json()(response)
+
+    params = [("filter", expression)]
+    if con.consistency == "stale":
+        params.append(("stale", "1"))
+    # The raw HTTP client is not traced by tracing.instrument
+    with tracing.span("consul.health.state", key="any", filter=expression):
+        checks = con.http.get(callback, "/v1/health/state/any", params=params)
+    # Consul before 1.5 ignores the filter, so apply it here as well
+    return [c for c in checks if c["Status"] != "passing" and c.get("ServiceName", "") in names]
+
+
+def runs_any_service(con, node, services) -> bool:
+    """Whether one of the services is registered on the node."""
+    _, data = con.catalog.node(node)
+    return any(service["Service"] in services for service in ((data or {}).get("Services") or {}).values())
+
+
+def may_have_failed_checks(con, hostname, tags: List[str], whitelist) -> bool:
+    """
+    Cheap pre-check before evaluating all cluster checks.
+
+    Returns False if no relevant check is failing. Services with a
+    min_passing tag can be unhealthy without a failing check (e.g. when an
+    instance is deregistered), so they always need the full evaluation.
+    Node checks, like the maintenance of a node, only count on nodes that
+    run one of the services, like in the full evaluation.
+    """
+    services = get_relevant_services(con, tags)
+    if any(tag.startswith("min_passing=") for service_tags in services.values() for tag in service_tags):
+        return True
+
+    failing_nodes = set()
+    for check in get_unhealthy_checks(con, services):
+        if check["Node"] in whitelist:
+            continue
+        if check["CheckID"] == "_node_maintenance" and check["Node"] == hostname:
+            continue
+        if check.get("ServiceName"):
+            return True
+        failing_nodes.add(check["Node"])
+    # Looking up many nodes one by one would cost more than the full evaluation
+    if len(failing_nodes) > NODE_LOOKUP_LIMIT:
+        return True
+    return any(runs_any_service(con, node, services) for node in sorted(failing_nodes))
 
 
-def check_consul_services(con, hostname, ignore_failed_checks: bool, tags: List[str], wait_until_healthy=False):
+def check_consul_services(con, hostname, ignore_failed_checks: bool, tags: List[str], wait_until_healthy=False,
+                          whitelist: Whitelist = None):
     """
     check all consul services for this node with the tag "rebootmgr"
     """
-    whitelist = get_whitelist(con)
+    if whitelist is None:
+        whitelist = get_whitelist(con)
 
     if whitelist:
         LOG.warning("Checks from the following hosts will be ignored, " +
-                    "because service/rebootmgr/ignore_failed_checks is set: {}".format(", ".join(whitelist)))
-
-    local_checks = get_local_checks(con, tags=tags)
-    LOG.debug("local_checks: %s" % local_checks)
+                    "because service/rebootmgr/ignore_failed_checks is set: {}".format(whitelist))
 
     if ignore_failed_checks:
         LOG.warning("All consul service checks are ignored.")
     else:
-        failed_cluster_checks = get_failed_cluster_checks(con, local_checks).items()
+        failed_cluster_checks = []
         failed_names = []
 
-        LOG.debug("failed_cluster_checks: %s" % failed_cluster_checks)
+        if may_have_failed_checks(con, hostname, tags, whitelist):
+            local_checks = get_local_checks(con, tags=tags)
+            LOG.debug("local_checks: %s", local_checks)
+            failed_cluster_checks = get_failed_cluster_checks(con, local_checks).items()
+
+        LOG.debug("failed_cluster_checks: %s", failed_cluster_checks)
         for name, check in failed_cluster_checks:
             if check["Node"] not in whitelist:
                 # If the check is failing because the node is us and it is the
@@ -159,6 +612,7 @@ def check_consul_services(con, hostname, ignore_failed_checks: bool, tags: List[
             if wait_until_healthy:
                 LOG.error("There were failed consul checks (%s). Trying again in 2 minutes.", failed_names)
                 time.sleep(120)
+                # Read the whitelist again, it may have been extended or an entry may have expired
                 check_consul_services(con, hostname, ignore_failed_checks, tags, wait_until_healthy)
             else:
                 LOG.error("There were failed consul checks (%s). Exit.", failed_names)
@@ -194,15 +648,19 @@ def resolve_group_key(con, group, hostname):
     Returns:
         Full key path as string.
     """
-    group_name = resolve_group_name(con, group, hostname)
+    return reboot_in_progress_key(resolve_group_name(con, group, hostname))
+
+
+def reboot_in_progress_key(group_name) -> str:
+    """The reboot status key of a group, or of the nodes without group."""
     if group_name:
         return f"service/rebootmgr/{group_name}_reboot_in_progress"
     return "service/rebootmgr/reboot_in_progress"
 
 
-def resolve_stop_flag(con, group, hostname):
+def resolve_lock(con, group, hostname):
     """
-    Resolve the correct stop flag from Consul KV store.
+    Resolve the correct lock key from Consul KV store.
 
     Group resolution is delegated to resolve_group_name:
     1. Use explicit group if provided.
@@ -212,31 +670,78 @@ def resolve_stop_flag(con, group, hostname):
     Returns:
         Full key path as string.
     """
-    group_name = resolve_group_name(con, group, hostname)
+    return lock_key(resolve_group_name(con, group, hostname))
+
+
+def lock_key(group_name) -> str:
+    """The lock key of a group, or of the nodes without group."""
     if group_name:
-        return f"service/rebootmgr/{group_name}_stop"
-    return "service/rebootmgr/stop"
+        return f"service/rebootmgr/{group_name}_lock"
+    return "service/rebootmgr/lock"
 
 
-def resolve_lock(con, group, hostname):
+def get_group_config(con, group, hostname) -> dict:
     """
-    Resolve the correct lock key from Consul KV store.
+    Get the group's config (service/rebootmgr/{group}_config), or the config
+    of nodes without group (service/rebootmgr/config). May be absent.
+    """
+    group_name = resolve_group_name(con, group, hostname)
+    key = f"service/rebootmgr/{group_name}_config" if group_name else "service/rebootmgr/config"
+    _, data = con.kv.get(key)
+    try:
+        if data and data.get("Value"):
+            config = json.loads(data["Value"].decode())
+            if isinstance(config, dict):
+                return config
+    except ValueError:
+        pass
+    if data:
+        LOG.error("Group configuration %s is malformed. Ignoring it.", key)
+    return {}
 
-    Group resolution is delegated to resolve_group_name:
-    1. Use explicit group if provided.
-    2. Use hostname-based group from config.
-    3. Fallback to default key.
 
-    Returns:
-        Full key path as string.
+def resolve_reboot_settings(con, group, hostname, reboot_method, reboot_delay) -> Tuple[str, int]:
     """
-    group_name = resolve_group_name(con, group, hostname)
-    if group_name:
-        return f"service/rebootmgr/{group_name}_lock"
-    return "service/rebootmgr/lock"
+    Resolve how to reboot: options given on the command line win over the
+    group config, which wins over the default (shutdown in 1 minute).
+    """
+    config = get_group_config(con, group, hostname)
+    if reboot_method is None:
+        reboot_method = config.get("reboot_method", "shutdown")
+    if reboot_delay is None:
+        # NOTE(sneubauer): Reboot after 1 minutes. This was added
+        # for the MachineDB reboot task, so it can report success
+        # to the API before the actual reboot happens.
+        reboot_delay = config.get("reboot_delay", 1)
+    # Fail before the pre boot tasks drain the node, not when it is about to reboot
+    if reboot_method not in backends.BACKENDS:
+        LOG.error("Unknown reboot method %r in the group configuration. Exit.", reboot_method)
+        sys.exit(EXIT_CONFIGURATION_IS_MISSING)
+    if not str(reboot_delay).isdigit():
+        LOG.error("Reboot delay %r in the group configuration is not a number of minutes. Exit.", reboot_delay)
+        sys.exit(EXIT_CONFIGURATION_IS_MISSING)
+    if parse_reboot_timeout(config) is None:
+        LOG.error("Reboot timeout %r in the group configuration is not a positive number of minutes. Exit.",
+                  config["reboot_timeout"])
+        sys.exit(EXIT_CONFIGURATION_IS_MISSING)
+    return reboot_method, int(reboot_delay)
+
 
+def parse_reboot_timeout(config):
+    """The reboot timeout of a group config in minutes (default: 60), or None if it is invalid."""
+    timeout = config.get("reboot_timeout", 60)
+    if not str(timeout).isdigit() or int(timeout) == 0:
+        return None
+    return int(timeout)
 
-@retry(wait_fixed=2000, stop_max_delay=20000)
+
+def reboot(reboot_method, reboot_delay):
+    """Reboot in reboot_delay minutes with the backend of reboot_method."""
+    LOG.info("Reboot with %s in %i minutes", reboot_method, reboot_delay)
+    backends.get_backend(reboot_method).reboot(reboot_delay)
+
+
+@retries.consul_retry
 def check_reboot_in_progress(con, group, hostname):
     """
     Check the reboot state of the host.
@@ -245,7 +750,7 @@ def check_reboot_in_progress(con, group, hostname):
         Decoded value of the resolved key if found, else empty string.
     """
     def get_decoded_value(key):
-        _, value = con.kv.get(key)
+        _, value = con.kv.get(key, consistency="consistent")
         if value and value.get("Value"):
             return value["Value"].decode()
         return ""
@@ -255,32 +760,76 @@ def check_reboot_in_progress(con, group, hostname):
     return get_decoded_value(group_key)
 
 
-@retry(wait_fixed=2000, stop_max_delay=20000)
-def check_stop_flag(con, group, hostname) -> Tuple[bool, str]:
+def _txn_get_trees(con, prefixes) -> dict:
     """
-    Check the Global stop flag first and then the group one. Present is True, absent is False.
+    Read all keys below the prefixes in one transaction.
+
+    Returns a dictionary from key to value. Unlike `get`, `get-tree` does not
+    fail the transaction for missing keys.
     """
-    LOG.info("Looking up Global stop flag from: service/rebootmgr/stop")
-    k, v = con.kv.get("service/rebootmgr/stop")
-    if v:
-        return True, "service/rebootmgr/stop"
-    else:
-        stop_flag = resolve_stop_flag(con, group, hostname)
-        LOG.info("Looking up stop flag from: /%s", stop_flag)
-        k, v = con.kv.get(stop_flag)
-        if v:
-            return True, stop_flag
-    return False, "Null"
+    if not prefixes:
+        return {}
+    result = con.txn.put([{"KV": {"Verb": "get-tree", "Key": prefix}} for prefix in prefixes])
+    values = {}
+    for r in result.get("Results") or []:
+        values[r["KV"]["Key"]] = base64.b64decode(r["KV"]["Value"]) if r["KV"].get("Value") else b""
+    return values
+
+
+def stop_flag_keys(group_name, hostname, tags) -> List[Tuple[str, str]]:
+    """The stop flags that apply to this node as (scope, key), in the order they are checked."""
+    keys = [("global", "service/rebootmgr/stop")]
+    if group_name:
+        keys.append(("group", f"service/rebootmgr/{group_name}_stop"))
+    keys.append(("node", f"service/rebootmgr/nodes/{hostname}/stop"))
+    keys += [("tag", f"service/rebootmgr/tags/{tag}/stop") for tag in tags]
+    return keys
+
+
+@retries.consul_retry
+def check_stop_flag(con, group, hostname) -> Tuple[bool, str, str]:
+    """
+    Check the global, group, node and tag stop flags. Returns whether one is
+    present, its key and its scope.
 
+    The global flag, the keys of the node (stop flag and config) and, with an
+    explicit group, the group flag are read in one transaction. Only flags
+    that depend on the node config (the group from the config and the tags)
+    need a second one.
+    """
+    LOG.info("Looking up Global stop flag from: service/rebootmgr/stop")
+    node_prefix = f"service/rebootmgr/nodes/{hostname}/"
+    prefixes = ["service/rebootmgr/stop", node_prefix]
+    if group:
+        prefixes.append(f"service/rebootmgr/{group}_stop")
+    values = _txn_get_trees(con, prefixes)
 
-@retry(wait_fixed=2000, stop_max_delay=20000)
+    try:
+        config = json.loads(values.get(node_prefix + "config", b"").decode())
+        if not isinstance(config, dict):
+            config = {}
+    except ValueError:
+        config = {}
+    tags = config.get("tags") or []
+    keys = stop_flag_keys(group or config.get("group"), hostname, tags)
+    group_keys = [key for scope, key in keys if scope == "group"]
+    LOG.info("Looking up stop flag from: /%s", group_keys[0] if group_keys else "service/rebootmgr/stop")
+    values.update(_txn_get_trees(con, [key for _, key in keys if not any(key.startswith(p) for p in prefixes)]))
+
+    for scope, key in keys:
+        if key in values:
+            return True, key, scope
+    return False, "Null", None
+
+
+@retries.consul_retry
 def is_reboot_required(con, nodename) -> bool:
     """
     Check the node's reboot_required flags. Present is True, absent is False.
     """
     k, v = con.kv.get("service/rebootmgr/nodes/%s/reboot_required" % nodename)
     if v:
-        LOG.debug("Found key %s. Reboot required" % nodename)
+        LOG.debug("Found key %s. Reboot required", nodename)
         return True
     if os.path.isfile("/var/run/reboot-required"):
         LOG.debug("Found file /var/run/reboot-required. Reboot required")
@@ -289,6 +838,63 @@ def is_reboot_required(con, nodename) -> bool:
     return False
 
 
+def get_boot_id() -> str:
+    """The kernel's random id of the current boot. It changes with every reboot."""
+    with open("/proc/sys/kernel/random/boot_id", "r") as f:
+        return f.read().strip()
+
+
+def make_reboot_record(hostname, phase, expected_duration, session=None, reboot_method=None) -> dict:
+    """
+    The value of the reboot_in_progress key, so that other nodes and
+    operators can follow the reboot and notice when it is stuck.
+
+    expected_duration is in seconds, counted from `started`.
+    """
+    now = time.time()
+    return {
+        "host": hostname,
+        "boot_id": get_boot_id(),
+        "phase": phase,
+        "started": now,
+        "updated": now,
+        "expected_duration": expected_duration,
+        "session": session,
+        "reboot_method": reboot_method,
+    }
+
+
+def parse_reboot_in_progress(value) -> dict:
+    """
+    Parse the value of the reboot_in_progress key.
+
+    Older versions wrote only the hostname, optionally followed by the boot
+    id before the reboot.
+    """
+    try:
+        record = json.loads(value)
+        if isinstance(record, dict) and "host" in record:
+            return record
+    except ValueError:
+        pass
+    hostname, _, boot_id = value.partition(" ")
+    return {"host": hostname, "boot_id": boot_id}
+
+
+def exit_if_post_reboot_only(post_reboot_only, reboot_in_progress, hostname):
+    """With --post-reboot-only, exit unless a reboot of this node is in progress."""
+    if post_reboot_only and parse_reboot_in_progress(reboot_in_progress)["host"] != hostname:
+        LOG.info("No reboot of this node is in progress. Exit.")
+        sys.exit(0)
+
+
+def describe_reboot_record(record) -> str:
+    if "started" not in record:
+        return record["host"]
+    minutes = (time.time() - record["started"]) / 60
+    return "%s (%s, started %i minutes ago)" % (record["host"], record.get("phase"), minutes)
+
+
 def uptime() -> float:
     with open('/proc/uptime', 'r') as f:
         uptime = float(f.readline().split()[0])
@@ -324,6 +930,11 @@ def get_all_node_groups(con):
     return groups
 
 
+def is_member_in_group(node_groups, local_group, name) -> bool:
+    """Whether the consul member `name` counts for the cluster check of a node of local_group."""
+    return not local_group or node_groups.get(name) in (local_group, None)
+
+
 def members_in_group(con, hostname):
     node_groups = get_all_node_groups(con)
 
@@ -339,7 +950,7 @@ def members_in_group(con, hostname):
         node_name = member.get("Name")
         group = node_groups.get(node_name)
 
-        if group == local_group or group is None:
+        if is_member_in_group(node_groups, local_group, node_name):
             matching_members.append(member)
         else:
             excluded_groups.add(group)  # pragma: no cover
@@ -353,49 +964,69 @@ def members_in_group(con, hostname):
     return matching_members
 
 
-def check_consul_cluster(con, hostname, ignore_failed_checks: bool) -> None:
-    whitelist = get_whitelist(con)
+def check_consul_cluster(con, hostname, ignore_failed_checks: bool, whitelist: Whitelist = None) -> None:
+    if whitelist is None:
+        whitelist = get_whitelist(con)
     if whitelist:
         LOG.warning("Status of the following hosts will be ignored, " +
-                    "because service/rebootmgr/ignore_failed_checks is set: {}".format(", ".join(whitelist)))
+                    "because service/rebootmgr/ignore_failed_checks is set: {}".format(whitelist))
     if ignore_failed_checks:
         LOG.warning("All consul cluster checks are ignored.")
     else:
         for member in members_in_group(con, hostname):
             # Consul member status 1 = Alive, 3 = Left
             if "Status" in member.keys() and member["Status"] not in [1, 3] and member["Name"] not in whitelist:
-                LOG.error("Consul cluster not healthy: Node %s failed. Exit" % member["Name"])
+                LOG.error("Consul cluster not healthy: Node %s failed. Exit", member["Name"])
                 sys.exit(EXIT_CONSUL_NODE_FAILED)
 
 
-@retry(wait_fixed=2000, stop_max_delay=20000)
+@retries.consul_retry
 def is_node_disabled(con, hostname) -> bool:
     data = get_config(con, hostname)
     return not data.get('enabled', False)
 
 
-def post_reboot_state(con, consul_lock, hostname, flags, wait_until_healthy, task_timeout, group):
+def post_reboot_state(con, consul_lock, hostname, flags, wait_until_healthy, task_timeout, group, whitelist=None,
+                      record=None):
+    """
+    record is the parsed value of the reboot_in_progress key.
+    """
+    record = record or {}
     group_key = resolve_group_key(con, group, hostname)
     LOG.info("Looking up group from: %s", group_key)
-    LOG.info("Found my hostname in %s" % group_key)
-
-    # Uptime greater 2 hours
-    if flags.get("check_uptime") and uptime() > 2 * 60 * 60:
+    LOG.info("Found my hostname in %s", group_key)
+
+    if record.get("boot_id"):
+        # A simulated reboot keeps the boot id
+        if record["boot_id"] == get_boot_id() and not backends.is_simulated(record.get("reboot_method")):
+            LOG.error("We are in post reboot state but the node did not reboot yet. Exit")
+            sys.exit(EXIT_DID_NOT_REALLY_REBOOT)
+    # Uptime greater 2 hours, for keys written without boot id
+    elif flags.get("check_uptime") and uptime() > 2 * 60 * 60:
         LOG.error("We are in post reboot state but uptime is higher then 2 hours. Exit")
         sys.exit(EXIT_DID_NOT_REALLY_REBOOT)
 
     LOG.info("Entering post reboot state")
-
-    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_postboot"], wait_until_healthy)
+    logs.set_phase("post_reboot")
+    if "phase" in record and not flags.get("dryrun"):
+        # Keep the boot id from before the reboot, it is checked again if the post reboot state fails
+        record.update(phase="post_boot", updated=time.time())
+        con.kv.put(group_key, json.dumps(record))
+
+    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_postboot"],
+                          wait_until_healthy, whitelist)
+    logs.set_phase("post_boot_tasks")
     run_tasks("post_boot", con, hostname, flags.get("dryrun"), task_timeout, group)
-    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_postboot"], wait_until_healthy)
+    logs.set_phase("post_reboot_checks")
+    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_postboot"],
+                          wait_until_healthy, whitelist)
 
     # Disable consul (and Zabbix) maintenance
     con.agent.maintenance(False)
 
-    LOG.info("Remove consul key service/rebootmgr/nodes/%s/reboot_required" % hostname)
+    LOG.info("Remove consul key service/rebootmgr/nodes/%s/reboot_required", hostname)
     con.kv.delete("service/rebootmgr/nodes/%s/reboot_required" % hostname)
-    LOG.info("Remove consul key %s" % group_key)
+    LOG.info("Remove consul key %s", group_key)
     con.kv.delete(group_key)
 
     consul_lock.release()
@@ -403,13 +1034,13 @@ def post_reboot_state(con, consul_lock, hostname, flags, wait_until_healthy, tas
 
 def _check_and_handle_stop_flag(con, group, hostname, flags):
     """Check if stop flag is set and handle it appropriately."""
-    must_stop, stop_flag = check_stop_flag(con, group, hostname)
+    must_stop, stop_flag, scope = check_stop_flag(con, group, hostname)
     if must_stop and not flags.get("ignore_stop_flag"):
-        LOG.info("Stop flag is set: exit (%s)" % stop_flag)
+        LOG.info("Stop flag is set: exit (%s, %s scope)", stop_flag, scope)
         sys.exit(EXIT_STOP_FLAG_SET)
 
 
-def pre_reboot_state(con, consul_lock, hostname, flags, task_timeout, group):
+def pre_reboot_state(con, consul_lock, hostname, flags, task_timeout, group, whitelist=None, session=None):
     group_key = resolve_group_key(con, group, hostname)
     today = datetime.date.today()
     if flags.get("check_holidays") and today in holidays.DE():
@@ -426,18 +1057,30 @@ def pre_reboot_state(con, consul_lock, hostname, flags, task_timeout, group):
         sys.exit(0)
 
     LOG.info("Entering pre reboot state")
+    logs.set_phase("pre_reboot")
 
-    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_preboot"])
+    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_preboot"], whitelist=whitelist)
 
     LOG.info("Executing pre reboot tasks")
-    run_tasks("pre_boot", con, hostname, flags.get("dryrun"), task_timeout, group)
+    logs.set_phase("pre_boot_tasks")
+    watcher = None
+    if not flags.get("ignore_stop_flag"):
+        watcher = StopFlagWatcher(con, group, hostname)
+        watcher.start()
+    try:
+        run_tasks("pre_boot", con, hostname, flags.get("dryrun"), task_timeout, group, watcher,
+                  flags.get("rollback_tasks_dir"))
+    finally:
+        if watcher:
+            watcher.close()
 
+    logs.set_phase("pre_reboot_checks")
     if not flags.get("lazy_consul_checks"):
         LOG.info("Sleep for 2 minutes. Waiting for consul checks.")
         time.sleep((60 * 2) + 10)
 
-    check_consul_cluster(con, hostname, flags.get("ignore_failed_checks"))
-    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_preboot"])
+    check_consul_cluster(con, hostname, flags.get("ignore_failed_checks"), whitelist)
+    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_preboot"], whitelist=whitelist)
 
     if not consul_lock.acquired:
         LOG.error("Lost consul lock. Exit")
@@ -450,44 +1093,186 @@ def pre_reboot_state(con, consul_lock, hostname, flags, task_timeout, group):
 
     if not flags.get("skip_reboot_in_progress_key"):
         if not flags.get("dryrun"):
-            LOG.debug("Write %s in key %s" % (hostname, group_key))
-            con.kv.put(group_key, hostname)
+            # The group config may have changed since the reboot settings were validated
+            expected_duration = (parse_reboot_timeout(get_group_config(con, group, hostname)) or 60) * 60
+            record = make_reboot_record(hostname, "rebooting", expected_duration, session, flags.get("reboot_method"))
+            LOG.debug("Write %s in key %s", record, group_key)
+            con.kv.put(group_key, json.dumps(record))
         else:
-            LOG.debug("Would write %s in %s" % (hostname, group_key))
+            LOG.debug("Would write %s in %s", hostname, group_key)
 
     consul_lock.release()
 
 
-def get_config(con, hostname) -> dict:
+def read_config(con, hostname) -> Tuple[dict, int]:
     """
-    Get the node's config data. It should be a JSON dictionary.
+    Get the node's config data and its ModifyIndex for check-and-set writes.
 
-    If the config is absent, the rebootmgr should consider itself disabled.
+    The index is 0 if the config is absent, so that a check-and-set write
+    only creates it if nobody else did in the meantime.
     """
-    idx, data = con.kv.get("service/rebootmgr/nodes/%s/config" % hostname)
+    # The config is written back, so it must never be read from a stale server
+    idx, data = con.kv.get("service/rebootmgr/nodes/%s/config" % hostname, consistency="default")
+    modify_index = data["ModifyIndex"] if data else 0
 
     try:
         if data and "Value" in data.keys() and data["Value"]:
             config = json.loads(data["Value"].decode())
             if isinstance(config, dict):
-                maybe_migrate_config(con, hostname, config)
-                return config
+                return config, modify_index
     except Exception:
         pass
 
     LOG.error("Configuration data missing or malformed.")
-    return {}
+    return {}, modify_index
 
 
-def maybe_migrate_config(con, hostname, config):
+def get_config(con, hostname) -> dict:
+    """
+    Get the node's config data. It should be a JSON dictionary.
+
+    If the config is absent, the rebootmgr should consider itself disabled.
+    """
+    config, modify_index = read_config(con, hostname)
+    if migrate_config(config) and not put_config(con, hostname, config, cas=modify_index):
+        LOG.info("Config of %s changed while migrating it, it is migrated with the next update", hostname)
+    return config
+
+
+def migrate_config(config) -> bool:
+    """Migrate the config of older versions in place. Returns whether it changed."""
     if 'disabled' in config and 'enabled' not in config:
         config['enabled'] = not config['disabled']
         del config['disabled']
-        put_config(con, hostname, config)
+        return True
+    return False
+
+
+def put_config(con, hostname, config, cas=None) -> bool:
+    """Write the node's config. With `cas`, only if its ModifyIndex is still `cas`."""
+    return con.kv.put("service/rebootmgr/nodes/%s/config" % hostname, json.dumps(config), cas=cas)
 
 
-def put_config(con, hostname, config):
-    con.kv.put("service/rebootmgr/nodes/%s/config" % hostname, json.dumps(config))
+def update_config(con, hostname, update, attempts=5) -> dict:
+    """
+    Read-modify-write of the node's config with check-and-set.
+
+    `update(config)` changes the config in place. If somebody else changed
+    the config in the meantime, it is read and updated again, so that no
+    concurrent update is lost.
+    """
+    for _ in range(attempts):
+        config, modify_index = read_config(con, hostname)
+        migrate_config(config)
+        update(config)
+        if put_config(con, hostname, config, cas=modify_index):
+            return config
+        LOG.info("Config of %s changed concurrently, retrying", hostname)
+    raise RuntimeError("Too many concurrent updates of the config of %s" % hostname)
+
+
+def disable_node(config, message):
+    config["enabled"] = False
+    config["message"] = message
+
+
+def read_host_patterns(host_patterns, hosts_file, used=True) -> list:
+    """
+    Host patterns from the command line and from a file with one per line.
+
+    `used` tells whether the action uses them, so that they are not ignored silently.
+    """
+    if (host_patterns or hosts_file) and not used:
+        raise click.UsageError("--hosts and --hosts-from need --set-local-stop-flag, --unset-local-stop-flag or --explain")
+    patterns = list(host_patterns)
+    if hosts_file:
+        patterns += [line.strip() for line in hosts_file if line.strip() and not line.startswith("#")]
+    return patterns
+
+
+def select_node_configs(con, patterns, group=None) -> list:
+    """
+    Consul items of the node configs of all hosts matching one of the
+    patterns, with one recursive read.
+
+    Patterns have the same format as the whitelist entries. With `group`,
+    only nodes of that group are selected.
+    """
+    _, items = con.kv.get("service/rebootmgr/nodes/", recurse=True, consistency="default")
+    configs = {}
+    for item in items or []:
+        key = item["Key"].split("/")
+        if len(key) == 5 and key[4] == "config":
+            configs[key[3]] = item
+
+    node_groups = {}
+    for host, item in configs.items():
+        try:
+            node_groups[host] = json.loads(item["Value"].decode()).get("group")
+        except (AttributeError, ValueError):
+            node_groups[host] = None
+
+    selection = Whitelist(patterns, node_groups)
+    return [item for host, item in sorted(configs.items())
+            if host in selection and (not group or node_groups[host] == group)]
+
+
+def _txn_get(con, keys) -> list:
+    """
+    Read keys in one transaction, as items like the ones of `kv.get`.
+
+    Keys that were deleted in the meantime are left out. Unlike `get`,
+    `get-tree` does not fail the transaction for them.
+    """
+    result = con.txn.put([{"KV": {"Verb": "get-tree", "Key": key}} for key in keys])
+    wanted = set(keys)
+    items = [r["KV"] for r in result.get("Results") or [] if r["KV"]["Key"] in wanted]
+    for item in items:
+        item["Value"] = base64.b64decode(item["Value"]) if item.get("Value") else None
+    return items
+
+
+def update_node_configs(con, items, update, chunk_size=64, attempts=5) -> list:
+    """
+    Update many node configs with check-and-set in batched transactions.
+
+    `update(hostname, config)` changes the config in place. A transaction
+    (at most 64 operations in consul) fails as a whole if another writer
+    changed one of its configs; then the configs are read again and updated
+    again. Returns the updated hostnames.
+    """
+    updated = []
+    for start in range(0, len(items), chunk_size):
+        chunk = items[start:start + chunk_size]
+        for attempt in range(attempts):
+            if not chunk:
+                break
+            ops = []
+            for item in chunk:
+                hostname = item["Key"].split("/")[3]
+                try:
+                    config = json.loads(item["Value"].decode())
+                except (AttributeError, ValueError):
+                    config = {}
+                migrate_config(config)
+                update(hostname, config)
+                value = base64.b64encode(json.dumps(config).encode()).decode()
+                ops.append({"KV": {"Verb": "cas", "Key": item["Key"], "Value": value, "Index": item["ModifyIndex"]}})
+            try:
+                con.txn.put(ops)
+                break
+            except ClientError as e:
+                LOG.info("Node configs changed concurrently, retrying (%s)", e)
+                keys = [item["Key"] for item in chunk]
+                chunk = _txn_get(con, keys)
+                if len(chunk) < len(keys):
+                    LOG.warning("Skipping deleted node configs: %s",
+                                ", ".join(sorted(set(keys) - {item["Key"] for item in chunk})))
+        else:
+            raise RuntimeError("Too many concurrent updates of node configs")
+        updated += [item["Key"].split("/")[3] for item in chunk]
+        LOG.info("Updated %i node configs", len(updated))
+    return updated
 
 
 def config_is_present_and_valid(con, hostname) -> bool:
@@ -510,15 +1295,473 @@ def ensure_configuration(con, hostname, dryrun) -> bool:
 
     If there already is one that looks valid, don't change it.
     """
-    if not config_is_present_and_valid(con, hostname):
-        config = {
-            "enabled": True,  # maybe default should be False?
-            "message": "Default config created",
-        }
-        if not dryrun:
-            put_config(con, hostname, config)
-        return True
-    return False
+    config, modify_index = read_config(con, hostname)
+    if migrate_config(config):
+        put_config(con, hostname, config, cas=modify_index)
+    if 'enabled' in config:
+        return False
+
+    config = {
+        "enabled": True,  # maybe default should be False?
+        "message": "Default config created",
+    }
+    if not dryrun and not put_config(con, hostname, config, cas=modify_index):
+        LOG.warning("Config of %s was changed concurrently, not replacing it", hostname)
+    return True
+
+
+def wait_for_consul(con, timeout) -> bool:
+    """
+    Wait up to timeout seconds until the consul agent is up and knows the
+    cluster leader, e.g. right after booting.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            if con.status.leader():
+                return True
+        except Exception as e:
+            LOG.debug("Consul is not ready yet: %s", e)
+        if time.time() >= deadline:
+            return False
+        time.sleep(2)
+
+
+def do_ensure_config(con, hostname, dryrun):
+    if ensure_configuration(con, hostname, dryrun):
+        LOG.warning("Created default configuration, "
+                    "since it was missing or invalid. Exit.")
+    else:
+        LOG.debug("Did not create default configuration, "
+                  "since there already was one. Exit.")
+
+
+def get_reboots_in_progress(con) -> dict:
+    """
+    Get all reboot_in_progress keys of all groups, with their consul data.
+
+    Returns a dictionary from group name (None without group) to the item.
+    """
+    _, keys = con.kv.get("service/rebootmgr/", keys=True, separator="/")
+    reboots = {}
+    for key in keys or []:
+        name = key[len("service/rebootmgr/"):]
+        if not name.endswith("reboot_in_progress"):
+            continue
+        _, item = con.kv.get(key, consistency="consistent")
+        if item and item.get("Value"):
+            reboots[name[:-len("_reboot_in_progress")] or None] = item
+    return reboots
+
+
+def do_watchdog(con, dryrun):
+    """
+    Find reboots that take longer than expected and handle them.
+
+    If the rebooting node is alive, the reboot is only escalated. If it is
+    not, the node is disabled and its reboot_in_progress key is removed, so
+    that the rest of the group can continue.
+
+    The watchdog may run on several nodes, so only the one holding the
+    watchdog lock of the datacenter acts.
+    """
+    # The session and the lock are writes, which are not needed most of the time
+    if not get_reboots_in_progress(con):
+        LOG.info("No reboot in progress. Exit")
+        return
+    session = con.session.create(ttl=60, checks=[])
+    lock = Lock(con, WATCHDOG_LOCK, session=session)
+    try:
+        if not lock.acquire(blocking=False):
+            LOG.info("Another watchdog is running. Exit")
+            return
+        members = {m["Name"]: m.get("Status") for m in con.agent.members()}
+        for group, item in get_reboots_in_progress(con).items():
+            try:
+                watch_reboot(con, group, item, members, dryrun)
+            except Exception as e:
+                # A broken record must not stop the watchdog for the other groups
+                LOG.error("Could not watch the reboot of group %s: %s", group or "-", e)
+    finally:
+        if lock.locked:
+            lock.release(keep_session="always")
+        con.session.destroy(session)
+
+
+def watch_reboot(con, group, item, members, dryrun):
+    record = parse_reboot_in_progress(item["Value"].decode())
+    if "started" not in record:
+        LOG.info("Reboot of %s has no start time, skipping it", record["host"])
+        return
+    expected_duration = record.get("expected_duration", 60 * 60)
+    if isinstance(expected_duration, bool) or not isinstance(expected_duration, (int, float)):
+        LOG.warning("Reboot of %s has an invalid expected duration %r, assuming 60 minutes",
+                    record["host"], expected_duration)
+        expected_duration = 60 * 60
+    minutes = (time.time() - record["started"]) / 60
+    if minutes * 60 <= expected_duration:
+        LOG.info("Reboot of %s is in progress for %i minutes", record["host"], minutes)
+        return
+    # The escalations of a stuck reboot must be the same on every run, so
+    # that they are deduplicated
+    started = datetime.datetime.fromtimestamp(record["started"]).strftime("%Y-%m-%d %H:%M")
+
+    if members.get(record["host"]) == MEMBER_ALIVE:
+        LOG.error("Reboot of %s is stuck in phase %s for %i minutes", record["host"], record.get("phase"), minutes)
+        message = "Reboot of %s is stuck in phase %s since %s" % (record["host"], record.get("phase"), started)
+        fire_chat_escalation(con, record["host"], message, group)
+        return
+
+    LOG.error("Reboot of %s did not finish within %i minutes and the node is down", record["host"], minutes)
+    if dryrun:
+        return
+    message = "Reboot of %s started at %s did not finish and the node is down. " \
+              "Disabled the node and released the reboot slot" % (record["host"], started)
+    # Disable the node before releasing its slot, so that it does not take
+    # part in the reboots again when it comes back
+    try:
+        update_config(con, record["host"], lambda config: disable_node(config, message))
+    except Exception as e:
+        LOG.error("Could not disable %s, keeping its reboot slot: %s", record["host"], e)
+        return
+    # Only reclaim the slot if nobody changed it in the meantime
+    if not con.kv.delete(item["Key"], cas=item["ModifyIndex"]):
+        LOG.error("%s changed in the meantime, keeping it", item["Key"])
+        # The node is disabled anyway, somebody has to look at it
+        message = "Reboot of %s started at %s did not finish and the node is down. " \
+                  "Disabled the node, but %s changed in the meantime and was kept" % (record["host"], started, item["Key"])
+    fire_chat_escalation(con, record["host"], message, group)
+
+
+def parse_config(value) -> dict:
+    """
+    Parse a config from consul, migrated like `get_config` does. Invalid JSON
+    and values that are no object are an empty config.
+    """
+    try:
+        config = json.loads(value)
+    except ValueError:
+        return {}
+    if not isinstance(config, dict):
+        return {}
+    migrate_config(config)
+    return config
+
+
+def get_status(con) -> dict:
+    """
+    Collect the state of all groups with one recursive read of the rebootmgr keys.
+
+    Nodes are assigned to the group from their config. Nodes without group
+    and the reboot in progress key without group belong to the group "".
+    """
+    _, items = con.kv.get("service/rebootmgr/", recurse=True)
+    members = {m["Name"]: m.get("Status") for m in con.agent.members()}
+    status = {"global_stop_flag": None, "tag_stop_flags": {}, "groups": {}}
+
+    def group_status(name):
+        if name not in status["groups"]:
+            status["groups"][name] = {"stop_flag": None, "reboot_in_progress": None, "nodes": 0, "reboot_required": [],
+                                      "disabled": {}, "unconfigured": [], "stopped": {}}
+        return status["groups"][name]
+
+    # The keys of each node, they are added once the tag stop flags are known
+    nodes = {}
+    for item in items or []:
+        name = item["Key"][len("service/rebootmgr/"):]
+        value = item["Value"].decode() if item.get("Value") else ""
+        if name.startswith("nodes/"):
+            # Anybody can put keys there, like folders ("nodes/foo/")
+            parts = name.split("/")
+            if len(parts) == 3 and parts[1] and parts[2] in ("config", "reboot_required", "stop"):
+                nodes.setdefault(parts[1], {})[parts[2]] = value
+        elif name.startswith("tags/") and name.endswith("/stop") and name.count("/") == 2:
+            status["tag_stop_flags"][name.split("/")[1]] = value
+        elif "/" in name:
+            continue
+        elif name == "stop":
+            status["global_stop_flag"] = value
+        elif name.endswith("_stop"):
+            group_status(name[:-len("_stop")])["stop_flag"] = value
+        elif name.endswith("reboot_in_progress") and value:
+            record = parse_reboot_in_progress(value)
+            record["member_status"] = MEMBER_STATUS.get(members.get(record["host"]), "unknown")
+            group_status(name[:-len("_reboot_in_progress")])["reboot_in_progress"] = record
+
+    for host, keys in sorted(nodes.items()):
+        add_node_status(group_status, host, keys, status["tag_stop_flags"])
+    return status
+
+
+def add_node_status(group_status, host, keys, tag_stop_flags):
+    """Add a node, from its keys below nodes/{host}/, to the status of its group."""
+    config = parse_config(keys["config"]) if "config" in keys else {}
+    group = group_status(config.get("group") or "")
+    if "config" in keys:
+        group["nodes"] += 1
+        # Like config_is_present_and_valid, a config without "enabled" never reboots
+        if "enabled" not in config:
+            group["unconfigured"].append(host)
+        elif not config["enabled"]:
+            group["disabled"][host] = config.get("message", "")
+    if "reboot_required" in keys:
+        group["reboot_required"].append(host)
+    # The node and tag stop flags, in the order check_stop_flag checks them
+    if "stop" in keys:
+        group["stopped"][host] = "nodes/%s/stop: %s" % (host, keys["stop"])
+        return
+    for tag in config.get("tags") or []:
+        if tag in tag_stop_flags:
+            group["stopped"][host] = "tags/%s/stop: %s" % (tag, tag_stop_flags[tag])
+            return
+
+
+def print_status(status):
+    click.echo("Global stop flag: %s" % (status["global_stop_flag"] or "-"))
+    for tag, reason in sorted(status["tag_stop_flags"].items()):
+        click.echo("Tag stop flag %s: %s" % (tag, reason))
+    click.echo("%-20s %-6s %-9s %-40s %s" % ("GROUP", "NODES", "STOPPED", "REBOOT IN PROGRESS", "REBOOT REQUIRED"))
+    for name, group in sorted(status["groups"].items()):
+        record = group["reboot_in_progress"]
+        click.echo("%-20s %-6i %-9s %-40s %s" % (
+            name or "-", group["nodes"], "yes" if group["stop_flag"] is not None else "no",
+            "%s [%s]" % (describe_reboot_record(record), record["member_status"]) if record else "-",
+            ", ".join(group["reboot_required"]) or "-"))
+    for name, group in sorted(status["groups"].items()):
+        for host, message in sorted(group["disabled"].items()):
+            click.echo("Disabled: %s (%s): %s" % (host, name or "-", message))
+        for host, stopped_by in sorted(group["stopped"].items()):
+            click.echo("Stopped: %s (%s): %s" % (host, name or "-", stopped_by))
+        for host in sorted(group["unconfigured"]):
+            click.echo("Missing or invalid config: %s (%s)" % (host, name or "-"))
+
+
+def do_status(con, status_format):
+    status = get_status(con)
+    if status_format == "json":
+        click.echo(json.dumps(status, indent=2, sort_keys=True))
+    else:
+        print_status(status)
+
+
+def gate_stop_flag(con, hostname, group, flags):
+    must_stop, stop_flag, scope = check_stop_flag(con, group, hostname)
+    if must_stop and not flags.get("ignore_stop_flag"):
+        return EXIT_STOP_FLAG_SET, "%s (%s scope)" % (stop_flag, scope)
+    return 0, "%s (%s scope), ignored" % (stop_flag, scope) if must_stop else "not set"
+
+
+def gate_config(con, hostname, group, flags):
+    if 'enabled' not in flags["config"]:
+        return EXIT_CONFIGURATION_IS_MISSING, "missing or invalid"
+    return 0, "present"
+
+
+def gate_disabled(con, hostname, group, flags):
+    config = flags["config"]
+    enabled = config.get("enabled", False)
+    if not enabled and not flags.get("ignore_node_disabled"):
+        return EXIT_NODE_DISABLED, "disabled: %s" % config.get("message", "")
+    return 0, "enabled" if enabled else "disabled, ignored"
+
+
+def gate_triggers(con, hostname, group, flags):
+    required = is_reboot_required(con, hostname)
+    if flags.get("check_triggers") and not required:
+        # Without a trigger, rebootmgr exits successfully without rebooting
+        return None, "no reboot required"
+    return 0, "reboot required" if required else "not checked"
+
+
+def gate_holidays(con, hostname, group, flags):
+    if not flags.get("check_holidays"):
+        return 0, "not checked"
+    if datetime.date.today() in holidays.DE():
+        return EXIT_HOLIDAY, "today is a holiday"
+    return 0, "no holiday"
+
+
+def gate_cluster(con, hostname, group, flags):
+    check_consul_cluster(con, hostname, flags.get("ignore_failed_checks"), flags.get("whitelist"))
+    return 0, "all members alive"
+
+
+def gate_services(con, hostname, group, flags):
+    check_consul_services(con, hostname, flags.get("ignore_failed_checks"), ["rebootmgr", "rebootmgr_preboot"],
+                          whitelist=flags.get("whitelist"))
+    return 0, "all checks passing"
+
+
+def gate_lock(con, hostname, group, flags):
+    group_name = group or flags["config"].get("group")
+    _, item = con.kv.get(lock_key(group_name), consistency="consistent")
+    if item and item.get("Session"):
+        return EXIT_CONSUL_LOCK_FAILED, "held by session %s" % item["Session"]
+    _, item = con.kv.get(reboot_in_progress_key(group_name), consistency="consistent")
+    reboot_in_progress = item["Value"].decode() if item and item.get("Value") else ""
+    if reboot_in_progress:
+        record = parse_reboot_in_progress(reboot_in_progress)
+        if record["host"] != hostname:
+            return EXIT_CONSUL_LOCK_FAILED, "%s is rebooting" % describe_reboot_record(record)
+        return 0, "free, post reboot phase of this node is pending"
+    return 0, "free"
+
+
+# The gates of a reboot, in the order the reboot checks them
+GATES = [
+    ("config", gate_config),
+    ("cluster", gate_cluster),
+    ("lock", gate_lock),
+    ("holidays", gate_holidays),
+    ("stop_flag", gate_stop_flag),
+    ("disabled", gate_disabled),
+    ("triggers", gate_triggers),
+    ("services", gate_services),
+]
+
+
+def evaluate_gate(func, con, hostname, group, flags) -> dict:
+    """Evaluate a gate. Checks that exit count as failed with their exit code."""
+    start = time.monotonic()
+    try:
+        code, detail = func(con, hostname, group, flags)
+    except SystemExit as e:
+        code, detail = e.code, "failed"
+    except Exception as e:
+        code, detail = EXIT_UNKNOWN_ERROR, "error: %s" % e
+    return {"passed": code == 0, "exit_code": code, "detail": detail, "ms": int((time.monotonic() - start) * 1000)}
+
+
+def do_preflight(con, hostname, group, flags, output_format):
+    """
+    Evaluate all gates of a reboot concurrently, without running tasks,
+    taking the lock or rebooting. Exits with the exit code of the first
+    failed gate, like a real run would. Nothing is written to consul, not
+    even the migration of an older config.
+    """
+    # The gates use this config, which is migrated in memory only
+    config, _ = read_config(con, hostname)
+    migrate_config(config)
+    flags = dict(flags, whitelist=get_whitelist(con), config=config)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(GATES)) as executor:
+        futures = [executor.submit(evaluate_gate, func, con, hostname, group, flags) for _, func in GATES]
+        results = {name: future.result() for (name, _), future in zip(GATES, futures)}
+
+    if output_format == "json":
+        click.echo(json.dumps(results, indent=2))
+    else:
+        click.echo("%-10s %-6s %7s  %s" % ("GATE", "RESULT", "TIME", "DETAIL"))
+        for name, result in results.items():
+            click.echo("%-10s %-6s %5ims  %s" % (name, "pass" if result["passed"] else "FAIL", result["ms"], result["detail"]))
+
+    failed = [result["exit_code"] for result in results.values() if not result["passed"]]
+    # Without a reboot trigger, the exit code is None, which is success
+    sys.exit(failed[0] if failed else 0)
+
+
+def explain_hosts(con, host_patterns, hostname, group=None) -> dict:
+    """
+    Explain why hosts would or would not reboot, from consul data only, so
+    that it works for any host from any node.
+
+    All hosts are explained with one recursive read of service/rebootmgr/,
+    one read of the members and one read of all health checks. The health
+    checks are approximated: checks of services that have a rebootmgr or
+    rebootmgr_preboot tag on the host count, also on other nodes.
+    """
+    _, items = con.kv.get("service/rebootmgr/", recurse=True)
+    values = {item["Key"][len("service/rebootmgr/"):]: item["Value"].decode() if item.get("Value") else ""
+              for item in items or []}
+    members = {m["Name"]: m.get("Status") for m in con.agent.members()}
+    _, checks = con.health.state("any")
+
+    configs = {}
+    for name, value in values.items():
+        if name.startswith("nodes/") and name.endswith("/config"):
+            configs[name.split("/")[1]] = parse_config(value)
+    node_groups = {host: config.get("group") for host, config in configs.items()}
+    try:
+        whitelist = Whitelist(json.loads(values.get("ignore_failed_checks") or "[]"), node_groups)
+    except ValueError:
+        whitelist = Whitelist([])
+    if host_patterns:
+        selection = Whitelist(host_patterns, node_groups)
+        # Hosts given by name are explained even without config
+        hosts = sorted({h for h in configs if h in selection} | selection.hosts)
+    else:
+        hosts = [hostname]
+    if group:
+        hosts = [h for h in hosts if node_groups.get(h) == group]
+
+    failed_members = [name for name, status in members.items() if status not in [1, 3] and name not in whitelist]
+    failing_checks = [c for c in checks if c["Status"] != "passing" and c["Node"] not in whitelist and not (
+        c["CheckID"].startswith("_service_maintenance") and "ignore_maintenance" in (c.get("ServiceTags") or []))]
+    services = {}
+    for check in checks:
+        if {"rebootmgr", "rebootmgr_preboot"} & set(check.get("ServiceTags") or []):
+            services.setdefault(check["Node"], set()).add(check["ServiceName"])
+
+    # Like members_in_group, only the members of the group of the host count
+    return {host: explain_host(host, configs.get(host), values, members,
+                               [m for m in failed_members if is_member_in_group(node_groups, node_groups.get(host), m)],
+                               failing_checks, services.get(host, set()))
+            for host in hosts}
+
+
+def explain_host(host, config, values, members, failed_members, failing_checks, services) -> dict:
+    """The reasons that keep one host from rebooting, in the order rebootmgr checks them."""
+    # A real run migrates the config of older versions before checking it
+    config = dict(config or {})
+    migrate_config(config)
+    group = config.get("group")
+    reasons = []
+    if "enabled" not in config:
+        reasons.append("node config is missing or invalid")
+    for scope, key in stop_flag_keys(group, host, config.get("tags") or []):
+        key = key[len("service/rebootmgr/"):]
+        if key in values:
+            reasons.append("%s stop flag %s is set: %s" % (scope, key, values[key]))
+    if config.get("enabled") is False:
+        reasons.append("node is disabled: %s" % config.get("message", ""))
+
+    reasons += ["consul member %s is not alive" % name for name in failed_members]
+    for check in failing_checks:
+        if check["ServiceName"] in services or (check["Node"] == host and not check["ServiceName"]):
+            if check["Node"] == host and check["CheckID"] == "_node_maintenance":
+                continue
+            reasons.append("check %s is %s on %s" % (check["Name"], check["Status"], check["Node"]))
+
+    reboot_in_progress = values.get(f"{group}_reboot_in_progress" if group else "reboot_in_progress")
+    post_reboot = False
+    if reboot_in_progress:
+        record = parse_reboot_in_progress(reboot_in_progress)
+        if record["host"] == host:
+            post_reboot = True
+        else:
+            reasons.append("%s is rebooting" % describe_reboot_record(record))
+
+    return {"group": group,
+            "member_status": MEMBER_STATUS.get(members.get(host), "unknown"),
+            "reboot_required": "nodes/%s/reboot_required" % host in values,
+            "post_reboot": post_reboot,
+            "reasons": reasons}
+
+
+def do_explain(con, host_patterns, hostname, group, output_format):
+    explanations = explain_hosts(con, host_patterns, hostname, group)
+    if output_format == "json":
+        click.echo(json.dumps(explanations, indent=2, sort_keys=True))
+        return
+    for host, explanation in explanations.items():
+        if explanation["post_reboot"]:
+            verdict = "would finish its reboot"
+        elif explanation["reasons"]:
+            verdict = "would not reboot"
+        else:
+            verdict = "would reboot" if explanation["reboot_required"] else "would reboot if triggered"
+        click.echo("%s (group %s, %s): %s" % (host, explanation["group"] or "-", explanation["member_status"], verdict))
+        for reason in explanation["reasons"]:
+            click.echo("    %s" % reason)
 
 
 def getuser():
@@ -526,37 +1769,122 @@ def getuser():
     return user or getpass.getuser()
 
 
-def do_set_global_stop_flag(con, dc, hostname, stop_reason):
+def resolve_datacenters(con, datacenters) -> List[str]:
+    """
+    Datacenters from a comma separated list, or all datacenters known to consul for "all".
+
+    Exits if there are none, so that no flag is silently left unchanged.
+    """
+    if datacenters == "all":
+        dcs = con.catalog.datacenters()
+    else:
+        dcs = [dc.strip() for dc in datacenters.split(",") if dc.strip()]
+    if not dcs:
+        LOG.error("No datacenters in %r", datacenters)
+        sys.exit(EXIT_STOP_FLAG_FAILED)
+    return dcs
+
+
+def for_each_datacenter(con, datacenters, func) -> List[str]:
+    """
+    Call `func(dc)` for all datacenters concurrently, so that it takes one
+    round trip instead of one per datacenter.
+
+    Logs the result and latency per datacenter and returns the datacenters
+    where it succeeded.
+    """
+    def timed(dc):
+        start = time.monotonic()
+        try:
+            func(dc)
+            return None, time.monotonic() - start
+        except Exception as e:
+            return e, time.monotonic() - start
+
+    succeeded = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(datacenters), 32) or 1) as executor:
+        for dc, (error, latency) in zip(datacenters, executor.map(timed, datacenters)):
+            if error:
+                LOG.error("Failed in dc %s after %i ms: %s", dc, latency * 1000, error)
+            else:
+                LOG.info("Done in dc %s in %i ms", dc, latency * 1000)
+                succeeded.append(dc)
+    return succeeded
+
+
+def do_set_global_stop_flag(con, datacenters, hostname, stop_reason):
     reason = f"Set by {getuser()}, {datetime.datetime.now()}, stop reason: {stop_reason}"
-    con.kv.put("service/rebootmgr/stop", reason, dc=dc)
-    chat_reaseon = f"Set global stop flag, {reason} in dc: {dc}"
-    fire_chat_escalation(con, hostname, chat_reaseon, resolve_group_name(con, None, hostname))
-    LOG.warning("Set %s global stop flag: %s", dc, reason)
+    dcs = resolve_datacenters(con, datacenters)
+    succeeded = for_each_datacenter(con, dcs, lambda dc: con.kv.put("service/rebootmgr/stop", reason, dc=dc))
+    if succeeded:
+        chat_reaseon = f"Set global stop flag, {reason} in dc: {', '.join(succeeded)}"
+        fire_chat_escalation(con, hostname, chat_reaseon, resolve_group_name(con, None, hostname))
+    for dc in succeeded:
+        LOG.warning("Set %s global stop flag: %s", dc, reason)
+    if len(succeeded) < len(dcs):
+        LOG.error("Could not set the global stop flag in dc: %s", ", ".join(sorted(set(dcs) - set(succeeded))))
+        sys.exit(EXIT_STOP_FLAG_FAILED)
+
+
+def do_unset_global_stop_flag(con, datacenters):
+    dcs = resolve_datacenters(con, datacenters)
+    succeeded = for_each_datacenter(con, dcs, lambda dc: con.kv.delete("service/rebootmgr/stop", dc=dc))
+    if succeeded:
+        chat_reaseon = f"Unset global stop flag in dc: {', '.join(succeeded)}"
+        fire_chat_escalation(con, None, chat_reaseon)
+    for dc in succeeded:
+        LOG.warning("Remove %s global stop flag", dc)
+    if len(succeeded) < len(dcs):
+        LOG.error("Could not remove the global stop flag in dc: %s", ", ".join(sorted(set(dcs) - set(succeeded))))
+        sys.exit(EXIT_STOP_FLAG_FAILED)
+
+
+def set_stop_flag_of_hosts(con, hostname, host_patterns, group, enabled, reason):
+    """Enable or disable all nodes matching the patterns, instead of this node."""
+    def update(_, config):
+        config["enabled"] = enabled
+        config["message"] = reason
 
+    items = select_node_configs(con, host_patterns, group)
+    if not items:
+        LOG.error("No node configs match %s", ", ".join(host_patterns))
+        sys.exit(EXIT_STOP_FLAG_FAILED)
+    hosts = update_node_configs(con, items, update)
 
-def do_unset_global_stop_flag(con, dc):
-    con.kv.delete("service/rebootmgr/stop", dc=dc)
-    chat_reaseon = f"Unset global stop flag in dc: {dc}"
-    fire_chat_escalation(con, None, chat_reaseon)
-    LOG.warning("Remove %s global stop flag", dc)
+    shown = ", ".join(hosts[:10]) + (", ..." if len(hosts) > 10 else "")
+    if enabled:
+        chat_reason = f"Unset local stop flag on {len(hosts)} nodes: {shown}"
+    else:
+        chat_reason = f"Set local stop flag on {len(hosts)} nodes: {shown}, {reason}"
+    fire_chat_escalation(con, hostname, chat_reason, group or None)
+    LOG.warning(chat_reason)
 
 
-def do_set_local_stop_flag(con, hostname, stop_reason):
+def check_group_selection(host_patterns, group):
+    """`--group` only limits the selected nodes, it does not select any by itself."""
+    if group and not host_patterns:
+        raise click.UsageError("--group needs --hosts or --hosts-from with --set-local-stop-flag and "
+                               "--unset-local-stop-flag, select all nodes of the group with --hosts 'group:%s'" % group)
+
+
+def do_set_local_stop_flag(con, hostname, stop_reason, host_patterns=None, group=None):
+    check_group_selection(host_patterns, group)
     reason = f"Node disabled by {getuser()}, {datetime.datetime.now()}, stop reason: {stop_reason}"
-    config = get_config(con, hostname)
-    config["enabled"] = False
-    config["message"] = reason
-    put_config(con, hostname, config)
+    if host_patterns:
+        set_stop_flag_of_hosts(con, hostname, host_patterns, group, False, reason)
+        return
+    update_config(con, hostname, lambda config: disable_node(config, reason))
     chat_reaseon = f"Set local stop flag, {reason}"
     fire_chat_escalation(con, hostname, chat_reaseon, resolve_group_name(con, None, hostname))
     LOG.warning("Set %s local stop flag: %s", hostname, reason)
 
 
-def do_unset_local_stop_flag(con, hostname):
-    config = get_config(con, hostname)
-    config["enabled"] = True
-    config["message"] = ""
-    put_config(con, hostname, config)
+def do_unset_local_stop_flag(con, hostname, host_patterns=None, group=None):
+    check_group_selection(host_patterns, group)
+    if host_patterns:
+        set_stop_flag_of_hosts(con, hostname, host_patterns, group, True, "")
+        return
+    update_config(con, hostname, lambda config: config.update(enabled=True, message=""))
     chat_reaseon = "Unset local stop flag."
     fire_chat_escalation(con, hostname, chat_reaseon, resolve_group_name(con, None, hostname))
     LOG.warning("Unset %s local stop flag", hostname)
@@ -589,13 +1917,22 @@ def do_unset_group_stop_flag(con, group, hostname):
 
 @click.command()
 @click.option("-v", "--verbose", count=True, help="Once for INFO logging, twice for DEBUG")
+@click.option("--log-format", type=click.Choice(["text", "json"]), help="Format of the log. Default env REBOOTMGR_LOG_FORMAT or text",
+              default=os.environ.get("REBOOTMGR_LOG_FORMAT", "text"))
+@click.option("--trace-file", help="Append a trace of the consul calls and tasks in OTLP JSON to this file. "
+              "Default env REBOOTMGR_TRACE_FILE or no tracing", default=os.environ.get("REBOOTMGR_TRACE_FILE"))
 @click.option("--check-triggers", help="Only reboot if a reboot is necessary", is_flag=True)
 @click.option("-n", "--dryrun", help="Run tasks and check services but don't reboot", is_flag=True)
-@click.option("-u", "--check-uptime", help="Make sure, that the uptime is less than 2 hours.", is_flag=True)
+@click.option("-u", "--check-uptime", help="Make sure, that the uptime is less than 2 hours, "
+              "if the reboot_in_progress key was written without boot id by an older version.", is_flag=True)
 @click.option("-s", "--ignore-stop-flag", help="ignore the related stop flag (example service/rebootmgr/ceph_stop).", is_flag=True)
 @click.option("--check-holidays", help="Don't reboot on holidays", is_flag=True)
 @click.option("--post-reboot-wait-until-healthy", help="Wait until healthy in post reboot, instead of exit", is_flag=True)
 @click.option("--lazy-consul-checks", help="Don't repeat consul checks after two minutes", is_flag=True)
+@click.option("--post-reboot-only", help="Only finish a reboot of this node, never start one. For running at boot time",
+              is_flag=True)
+@click.option("--wait-for-consul", "wait_for_consul_timeout", metavar="SECONDS", help="Wait until consul is ready, e.g. at boot time. Default: don't wait",
+              default=0, type=click.IntRange(min=0))
 @click.option("-l", "--ignore-node-disabled", help="ignore the node specific stop flag (service/rebootmgr/hostname/config)", is_flag=True)
 @click.option("--ignore-failed-checks", help="Reboot even if consul checks fail", is_flag=True)
 @click.option("--maintenance-reason", help="""Reason for the downtime in consul. If the text starts with "reboot", """ +
@@ -605,75 +1942,128 @@ def do_unset_group_stop_flag(con, group, hostname):
               default=os.environ.get("REBOOTMGR_CONSUL_ADDR", "127.0.0.1"))
 @click.option("--consul-port", help="Port of Consul. Default env REBOOTMGR_CONSUL_PORT or 8500",
               default=os.environ.get("REBOOTMGR_CONSUL_PORT", 8500))
+@click.option("--consul-stale-reads", help="Allow any consul server to answer reads that don't decide about locking, "
+              "like the whitelist and node groups. Default env REBOOTMGR_CONSUL_STALE_READS", is_flag=True,
+              default=bool(os.environ.get("REBOOTMGR_CONSUL_STALE_READS")))
 @click.option("--ensure-config", help="If there is no valid configuration in consul, create a default one.", is_flag=True)
-@click.option("--set-global-stop-flag", metavar="CLUSTER", help="Stop the rebootmgr cluster-wide in the specified cluster")
-@click.option("--unset-global-stop-flag", metavar="CLUSTER", help="Remove the cluster-wide stop flag in the specified cluster")
+@click.option("--set-global-stop-flag", metavar="CLUSTER", help="Stop the rebootmgr cluster-wide in the specified cluster. "
+              "Several clusters can be separated by commas, \"all\" are all datacenters known to consul")
+@click.option("--unset-global-stop-flag", metavar="CLUSTER", help="Remove the cluster-wide stop flag in the specified cluster. "
+              "Several clusters can be separated by commas, \"all\" are all datacenters known to consul")
 @click.option("--set-group-stop-flag", help="Stop the rebootmgr for this group (requires --group or group in node config)", is_flag=True)
 @click.option("--unset-group-stop-flag", help="Remove the group stop flag (requires --group or group in node config)", is_flag=True)
 @click.option("--set-local-stop-flag", help="Stop the rebootmgr on this node", is_flag=True)
 @click.option("--unset-local-stop-flag", help="Remove the stop flag on this node", is_flag=True)
+@click.option("--hosts", "host_patterns", metavar="PATTERN", multiple=True,
+              help="Set or unset the local stop flag on, or explain, all nodes matching the pattern (like \"compute-*\" or "
+                   "\"group:ceph\") instead of this node. Only nodes of --group, if given. Can be repeated")
+@click.option("--hosts-from", "hosts_file", type=click.File(), help="Like --hosts, with one pattern per line of the file")
 @click.option("--stop-reason", help="Reason to set the stop flag", default="stopped by rebootmgr")
+@click.option("--watchdog", help="Handle reboots of all groups that take longer than expected, then exit", is_flag=True)
+@click.option("--status", help="Show the state of all groups, then exit", is_flag=True)
+@click.option("--explain", help="Explain why this node or the nodes of --hosts would (not) reboot, then exit", is_flag=True)
+@click.option("--preflight", help="Evaluate all conditions of a reboot without side effects, then exit", is_flag=True)
+@click.option("--status-format", type=click.Choice(["table", "json"]), default="table", show_default=True,
+              help="Output format of --status, --explain and --preflight")
 @click.option("--skip-reboot-in-progress-key", help="Don't set the reboot_in_progress consul key before rebooting", is_flag=True)
+@click.option("--rollback-tasks-dir", metavar="DIR", default="/etc/rebootmgr/pre_boot_rollback_tasks", show_default=True,
+              help="Scripts that undo the pre boot tasks of the same name, when a task fails or a stop flag aborts them")
 @click.option("--task-timeout", help="Minutes that rebootmgr waits for each task to finish. Default are 120 minutes", default=120, type=int)
+@click.option("--reboot-method", type=click.Choice(sorted(backends.BACKENDS)),
+              help="How to reboot. kexec skips the firmware. "
+                   "Default from group config or shutdown")
+@click.option("--reboot-delay", metavar="MINUTES", type=click.IntRange(min=0),
+              help="Minutes between the decision to reboot and the reboot. Default from group config or 1 minute")
 @click.option("--group", help="Group name this host belongs to in our infrastructure", default="", type=str)
+@click.option("--escalation-sink", "escalation_sinks", metavar="SINK", multiple=True, default=["consul"],
+              help="Where to deliver escalations: consul, journal, stdout, file:PATH or webhook:URL. "
+                   "Can be given multiple times. Default: consul")
 @click.version_option()
-def cli(verbose, consul, consul_port, check_triggers, check_uptime, dryrun, maintenance_reason, ignore_stop_flag,
+@logs.log_exit_code
+def cli(verbose, log_format, trace_file, consul, consul_port, consul_stale_reads, check_triggers, check_uptime, dryrun, maintenance_reason, ignore_stop_flag,
         ignore_node_disabled, ignore_failed_checks, check_holidays, post_reboot_wait_until_healthy, lazy_consul_checks,
+        post_reboot_only, wait_for_consul_timeout,
         ensure_config, set_global_stop_flag, unset_global_stop_flag, set_group_stop_flag, unset_group_stop_flag,
-        set_local_stop_flag, unset_local_stop_flag, stop_reason,
-        skip_reboot_in_progress_key, task_timeout, group):
+        set_local_stop_flag, unset_local_stop_flag, host_patterns, hosts_file, stop_reason, watchdog, status, explain, preflight, status_format,
+        skip_reboot_in_progress_key, rollback_tasks_dir, task_timeout, reboot_method, reboot_delay, group, escalation_sinks):
     """Reboot Manager
 
     Default values of parameteres are environment variables (if set)
     """
-    logsetup(verbose)
-
-    con = Consul(host=consul, port=int(consul_port))
     hostname = socket.gethostname().split(".")[0]
+    logs.RUN.reset(hostname, group or None)
+    logsetup(verbose, log_format)
+    host_patterns = read_host_patterns(host_patterns, hosts_file, set_local_stop_flag or unset_local_stop_flag or explain)
+    retries.reset()
+    click.get_current_context().call_on_close(retries.log_stats)
+    if trace_file:
+        tracing.start(trace_file)
+        # Registered first, so the trace is written after the escalations are delivered
+        click.get_current_context().call_on_close(tracing.stop)
+
+    # Reads of the lock, the reboot_in_progress key, the stop flags and the
+    # node config always override the consistency mode.
+    con = tracing.instrument(Consul(host=consul, port=int(consul_port), consistency="stale" if consul_stale_reads else "default"))
+
+    if wait_for_consul_timeout and not wait_for_consul(con, wait_for_consul_timeout):
+        LOG.error("Consul is not ready after %i seconds. Exit", wait_for_consul_timeout)
+        sys.exit(EXIT_CONSUL_NOT_READY)
 
-    if ensure_config:
-        if ensure_configuration(con, hostname, dryrun):
-            LOG.warning("Created default configuration, "
-                        "since it was missing or invalid. Exit.")
-        else:
-            LOG.debug("Did not create default configuration, "
-                      "since there already was one. Exit.")
-        sys.exit(0)
+    try:
+        escalation.start(con, escalation_sinks)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--escalation-sink")
+    # Deliver the remaining escalations on every exit path, but don't hang forever
+    click.get_current_context().call_on_close(escalation.stop)
+
+    flags = {"check_triggers": check_triggers,
+             "check_uptime": check_uptime,
+             "dryrun": dryrun,
+             "maintenance_reason": maintenance_reason,
+             "ignore_stop_flag": ignore_stop_flag,
+             "ignore_node_disabled": ignore_node_disabled,
+             "ignore_failed_checks": ignore_failed_checks,
+             "check_holidays": check_holidays,
+             "lazy_consul_checks": lazy_consul_checks,
+             "skip_reboot_in_progress_key": skip_reboot_in_progress_key,
+             "rollback_tasks_dir": rollback_tasks_dir,
+             "group": group}
 
     # Map flags to their corresponding functions and arguments
-    stop_flag_actions = {
+    actions = {
+        'ensure_config': (do_ensure_config, (con, hostname, dryrun)),
         'set_global_stop_flag': (do_set_global_stop_flag, (con, set_global_stop_flag, hostname, stop_reason)),
         'unset_global_stop_flag': (do_unset_global_stop_flag, (con, unset_global_stop_flag)),
         'set_group_stop_flag': (do_set_group_stop_flag, (con, group, hostname, stop_reason)),
         'unset_group_stop_flag': (do_unset_group_stop_flag, (con, group, hostname)),
-        'set_local_stop_flag': (do_set_local_stop_flag, (con, hostname, stop_reason)),
-        'unset_local_stop_flag': (do_unset_local_stop_flag, (con, hostname)),
+        'set_local_stop_flag': (do_set_local_stop_flag, (con, hostname, stop_reason, host_patterns, group)),
+        'unset_local_stop_flag': (do_unset_local_stop_flag, (con, hostname, host_patterns, group)),
+        'watchdog': (do_watchdog, (con, dryrun)),
+        'status': (do_status, (con, status_format)),
+        'explain': (do_explain, (con, host_patterns, hostname, group, status_format)),
+        'preflight': (do_preflight, (con, hostname, group, flags, status_format)),
     }
 
     # Execute the first matching action
-    for flag_name, (func, args) in stop_flag_actions.items():
+    for flag_name, (func, args) in actions.items():
         if locals()[flag_name]:
             func(*args)
             sys.exit(0)
 
     if not config_is_present_and_valid(con, hostname):
         LOG.error("The configuration of this node (%s) seems to be missing. "
-                  "Exit." % hostname)
+                  "Exit.", hostname)
         sys.exit(EXIT_CONFIGURATION_IS_MISSING)
 
-    flags = {"check_triggers": check_triggers,
-             "check_uptime": check_uptime,
-             "dryrun": dryrun,
-             "maintenance_reason": maintenance_reason,
-             "ignore_stop_flag": ignore_stop_flag,
-             "ignore_node_disabled": ignore_node_disabled,
-             "ignore_failed_checks": ignore_failed_checks,
-             "check_holidays": check_holidays,
-             "lazy_consul_checks": lazy_consul_checks,
-             "skip_reboot_in_progress_key": skip_reboot_in_progress_key,
-             "group": group}
+    logs.RUN.group = resolve_group_name(con, group, hostname)
+    escalation.flush(con)
+    reboot_in_progress = check_reboot_in_progress(con, group, hostname)
+    exit_if_post_reboot_only(post_reboot_only, reboot_in_progress, hostname)
 
-    check_consul_cluster(con, hostname, ignore_failed_checks)
+    check_tasks(con, hostname, group, task_directories(reboot_in_progress, hostname, rollback_tasks_dir))
+
+    whitelist = get_whitelist(con)
+    check_consul_cluster(con, hostname, ignore_failed_checks, whitelist)
 
     lock_key = resolve_lock(con, group, hostname)
     # Explicitly disable all health checks on the session. Some scripts may
@@ -694,35 +2084,40 @@ def cli(verbose, consul, consul_port, check_triggers, check_uptime, dryrun, main
             sys.exit(EXIT_CONSUL_LOCK_FAILED)
 
         reboot_in_progress = check_reboot_in_progress(con, group, hostname)
+        # Another run may have finished the post reboot phase before we got the lock
+        exit_if_post_reboot_only(post_reboot_only, reboot_in_progress, hostname)
 
         if reboot_in_progress:
-            if reboot_in_progress.startswith(hostname):
+            record = parse_reboot_in_progress(reboot_in_progress)
+            if record["host"] == hostname:
                 # We are in post_reboot state
-                post_reboot_state(con, consul_lock, hostname, flags, post_reboot_wait_until_healthy, task_timeout, group)
+                post_reboot_state(con, consul_lock, hostname, flags, post_reboot_wait_until_healthy, task_timeout, group,
+                                  whitelist, record)
                 sys.exit(0)
             # Another node has the lock
             else:
-                LOG.info("Another Node %s is rebooting. Exit." % reboot_in_progress)
+                LOG.info("Another Node %s is rebooting. Exit.", describe_reboot_record(record))
                 sys.exit(EXIT_CONSUL_LOCK_FAILED)
         # consul-key reboot_in_progress does not exist
         # we are free to reboot
         else:
             # We are in pre_reboot state
-            pre_reboot_state(con, consul_lock, hostname, flags, task_timeout, group)
+            reboot_settings = resolve_reboot_settings(con, group, hostname, reboot_method, reboot_delay)
+            # The reboot method is part of the reboot_in_progress record
+            flags["reboot_method"] = reboot_settings[0]
+            pre_reboot_state(con, consul_lock, hostname, flags, task_timeout, group, whitelist, session)
             group_key = resolve_group_key(con, group, hostname)
             if not dryrun:
                 # Set a consul maintenance, which creates a 15 maintenance window in Zabbix
                 con.agent.maintenance(True, maintenance_reason)
 
                 LOG.warning("Reboot now ...")
+                logs.set_phase("reboot")
                 try:
-                    # NOTE(sneubauer): Reboot after 1 minutes. This was added
-                    # for the MachineDB reboot task, so it can report success
-                    # to the API before the actual reboot happens.
-                    subprocess.run(["shutdown", "-r", "+1"], check=True)
+                    reboot(*reboot_settings)
                 except Exception as e:
                     LOG.error("Could not run reboot")
-                    LOG.error("Remove consul key %s" % group_key)
+                    LOG.error("Remove consul key %s", group_key)
                     con.kv.delete(group_key)
                     raise e
     finally:
@@ -0,0 +1,123 @@
+"""
+Shared retry policy for consul reads.
+
+Only transient errors are retried: connection errors, timeouts and 5xx
+responses, like during a leader election. Other errors, including bugs, fail
+right away. The waits grow exponentially and half of each wait is random, so
+that the nodes of a datacenter don't retry in lockstep. All retries of a run
+share a budget, so an unavailable consul doesn't multiply the runtime with
+the number of reads.
+"""
+import functools
+import logging
+import random
+import re
+import threading
+
+import requests
+from consul.base import ConsulException, Timeout
+from retrying import retry
+
+LOG = logging.getLogger(__name__)
+
+RETRY_BUDGET = 20
+WAIT_BASE_MS = 500
+WAIT_MAX_MS = 8000
+STOP_MAX_DELAY_MS = 20000
+
+_lock = threading.Lock()
+_budget = RETRY_BUDGET
+# Budget of threads that don't share the budget of the run
+_local = threading.local()
+# Retries per function and the number of calls that gave up
+STATS = {"retries": {}, "gave_up": 0, "budget_exhausted": 0}
+
+
+def reset(budget=RETRY_BUDGET):
+    """Start a new run with a fresh budget and statistics."""
+    global _budget
+    with _lock:
+        _budget = budget
+        STATS["retries"] = {}
+        STATS["gave_up"] = 0
+        STATS["budget_exhausted"] = 0
+
+
+def use_own_budget(budget=RETRY_BUDGET):
+    """
+    Give the calling thread its own budget, so that a long running background
+    thread, like the stop flag watcher, cannot use up the budget of the run.
+    """
+    _local.budget = budget
+
+
+def _remaining() -> int:
+    own = getattr(_local, "budget", None)
+    return _budget if own is None else own
+
+
+def _spend():
+    global _budget
+    if getattr(_local, "budget", None) is None:
+        _budget -= 1
+    else:
+        _local.budget -= 1
+
+
+def is_transient(exception) -> bool:
+    """Whether the error may go away by itself."""
+    if isinstance(exception, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, Timeout)):
+        return True
+    # python-consul raises ConsulException for 5xx and subclasses of it for 4xx
+    return type(exception) is ConsulException and bool(re.match(r"5\d\d ", str(exception)))
+
+
+def wait_ms(attempt_number) -> int:
+    """Exponential backoff with equal jitter."""
+    wait = min(WAIT_MAX_MS, WAIT_BASE_MS * 2 ** (attempt_number - 1))
+    return int(wait / 2 + random.uniform(0, wait / 2))
+
+
+def _should_retry(name, exception) -> bool:
+    if not is_transient(exception):
+        return False
+    with _lock:
+        if _remaining() > 0:
+            return True
+        STATS["budget_exhausted"] += 1
+    LOG.warning("Retry budget of the run is exhausted, not retrying %s: %s", name, exception)
+    return False
+
+
+def _wait(name, attempt_number, delay_since_first_attempt_ms):
+    with _lock:
+        _spend()
+        STATS["retries"][name] = STATS["retries"].get(name, 0) + 1
+    delay = wait_ms(attempt_number)
+    LOG.info("Transient error in %s, retry in %i ms", name, delay)
+    return delay
+
+
+def consul_retry(func):
+    """Retry `func` on transient consul errors, following the shared policy."""
+    retrying_func = retry(wait_func=functools.partial(_wait, func.__name__), stop_max_delay=STOP_MAX_DELAY_MS,
+                          retry_on_exception=functools.partial(_should_retry, func.__name__))(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return retrying_func(*args, **kwargs)
+        except Exception as e:
+            if is_transient(e):
+                with _lock:
+                    STATS["gave_up"] += 1
+            raise
+    return wrapper
+
+
+def log_stats():
+    """Log the retries of the run, if there were any."""
+    if STATS["retries"] or STATS["gave_up"] or STATS["budget_exhausted"]:
+        LOG.info("Retries: %s, gave up: %i, budget exhausted: %i",
+                 ", ".join("%s=%i" % item for item in sorted(STATS["retries"].items())) or "-",
+                 STATS["gave_up"], STATS["budget_exhausted"])
@@ -0,0 +1,195 @@
+"""
+Optional tracing of consul calls and tasks.
+
+Spans are written as OTLP JSON (one `ExportTraceServiceRequest` per line, the
+format of the OpenTelemetry collector file exporter), so the trace of a run can
+be loaded into any OpenTelemetry compatible backend. The trace id is the run
+id of the logs.
+
+Without `start`, `span` returns a shared no-op span and the consul client is
+not wrapped, so tracing costs nothing when it is disabled.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from rebootmgr import logs
+
+LOG = logging.getLogger(__name__)
+
+# Attributes of the consul client that are wrapped by `instrument`
+CONSUL_ENDPOINTS = ("kv", "txn", "agent", "health", "catalog", "session", "event", "status")
+
+_TRACER = None
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _now_ns():
+    return int(time.time() * 1e9)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Span:
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.span_id = os.urandom(8).hex()
+        self.attributes = dict(attributes)
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = _now_ns()
+        self.tracer.stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = _now_ns()
+        self.tracer.stack().pop()
+        # Exiting is the normal way to abort the run, not an error of the span
+        if exc is not None and not isinstance(exc, SystemExit):
+            self.error = "%s: %s" % (exc_type.__name__, exc)
+        self.tracer.finish(self)
+        return False
+
+    def to_otlp(self, trace_id):
+        span = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 3 if self.name.startswith("consul.") else 1,  # CLIENT or INTERNAL
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [_attribute(k, v) for k, v in self.attributes.items() if v is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent:
+            span["parentSpanId"] = self.parent.span_id
+        return span
+
+
+class Tracer:
+    """Collect the spans of a run and write them to `path` at the end."""
+
+    def __init__(self, path):
+        self.path = path
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.root = None
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def span(self, name, **attributes):
+        stack = self.stack()
+        # Spans of other threads are children of the run
+        return Span(self, name, stack[-1] if stack else self.root, attributes)
+
+    def finish(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def export(self):
+        trace_id = logs.RUN.run_id
+        with self.lock:
+            spans = [s.to_otlp(trace_id) for s in self.spans]
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", "rebootmgr"),
+                                        _attribute("host.name", logs.RUN.hostname)]},
+            "scopeSpans": [{"scope": {"name": "rebootmgr"}, "spans": spans}],
+        }]}
+        with open(self.path, "a") as f:
+            f.write(json.dumps(request) + "\n")
+
+
+def start(path, name="rebootmgr"):
+    """Trace the run into `path` until `stop` is called."""
+    global _TRACER
+    _TRACER = Tracer(path)
+    _TRACER.root = _TRACER.span(name)
+    _TRACER.root.__enter__()
+
+
+def stop():
+    """End the run span and write the trace."""
+    global _TRACER
+    if not _TRACER:
+        return
+    tracer, _TRACER = _TRACER, None
+    tracer.root.set_attribute("group", logs.RUN.group)
+    tracer.root.set_attribute("exit_code", logs.RUN.exit_code)
+    tracer.root.__exit__(None, None, None)
+    try:
+        tracer.export()
+    except OSError as e:
+        LOG.warning("Could not write trace to %s: %s", tracer.path, e)
+
+
+def span(name, **attributes):
+    """A span around a block of code, if tracing is enabled."""
+    if not _TRACER:
+        return _NOOP_SPAN
+    return _TRACER.span(name, **attributes)
+
+
+class _TracedEndpoint:
+    """Proxy of a consul endpoint (`con.kv`, ...) that traces every call."""
+
+    def __init__(self, endpoint, name):
+        self._endpoint = endpoint
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._endpoint, attr)
+        name = "%s.%s" % (self._name, attr)
+        if callable(value):
+            @functools.wraps(value)
+            def traced(*args, **kwargs):
+                key = args[0] if args and isinstance(args[0], str) else None
+                with span(name, key=key, dc=kwargs.get("dc")):
+                    return value(*args, **kwargs)
+            return traced
+        # Nested endpoints, like `con.agent.service`
+        if type(value).__module__.startswith("consul"):
+            return _TracedEndpoint(value, name)
+        return value
+
+
+def instrument(con):
+    """Trace all calls of the consul client, if tracing is enabled."""
+    if not _TRACER:
+        return con
+    for endpoint in CONSUL_ENDPOINTS:
+        setattr(con, endpoint, _TracedEndpoint(getattr(con, endpoint), "consul.%s" % endpoint))
+    return con
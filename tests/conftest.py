@@ -154,7 +154,7 @@ def run_cli():
 
 @pytest.fixture
 def reboot_task(mocker, mock_subprocess_popen):
-    tasks = {"pre_boot": [], "post_boot": []}
+    tasks = {"pre_boot": [], "post_boot": [], "pre_boot_rollback": []}
 
     def listdir(directory):
         # TODO: Make task directories configurable to avoid mocking them in tests.
@@ -163,12 +163,16 @@ def reboot_task(mocker, mock_subprocess_popen):
             return tasks["pre_boot"]
         elif directory == "/etc/rebootmgr/post_boot_tasks/":
             return tasks["post_boot"]
+        elif directory == "/etc/rebootmgr/pre_boot_rollback_tasks" and tasks["pre_boot_rollback"]:
+            return tasks["pre_boot_rollback"]
         else:
             raise FileNotFoundError
     mocker.patch("os.listdir", new=listdir)
+    # The tasks don't exist, so they can't be validated
+    mocker.patch("rebootmgr.main.validate_task", return_value=None)
 
     def create_task(tasktype, filename, exit_code=0, raise_timeout_expired=False):
-        assert tasktype in ["pre_boot", "post_boot"], "task type must be either pre_boot or post_boot"
+        assert tasktype in tasks, "task type must be pre_boot, post_boot or pre_boot_rollback"
 
         tasks[tasktype] += [filename]
 
@@ -1,6 +1,16 @@
+import http.server
+import json
 import socket
+import syslog
+import threading
+import time
+
+import pytest
 
 from rebootmgr.main import cli as rebootmgr
+from rebootmgr.escalation import chat_escalation_key
+from rebootmgr.escalation import ConsulEventSink, EscalationQueue, FileSink, JournalSink, StdoutSink, WebhookSink
+from rebootmgr.escalation import make_escalation, make_sink
 
 
 def test_chat_escalation_on_task_failure(
@@ -72,3 +82,288 @@ def test_chat_escalation_failure_does_not_block(
 
     assert result.exit_code == 100
     assert "Failed to fire chat_escalation event" in result.output
+
+
+def test_chat_escalation_is_deduplicated_within_window(
+        run_cli, forward_consul_port, consul_cluster, default_config,
+        reboot_task, mocker):
+    """Another node already escalated the same failure, so no event is fired."""
+    message = "Task /etc/rebootmgr/pre_boot_tasks/00_some_task.sh failed with return code 1"
+    key = chat_escalation_key(message)
+    consul_cluster[0].kv.put(key, json.dumps(
+        {"group": None, "message": message, "since": time.time(), "nodes": ["consul2"]}))
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.run")
+    reboot_task("pre_boot", "00_some_task.sh", exit_code=1)
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 100
+    mocked_fire.assert_not_called()
+    _, data = consul_cluster[0].kv.get(key)
+    assert json.loads(data["Value"].decode())["nodes"] == ["consul2", "consul1"]
+
+
+def test_chat_escalation_summary_after_window(
+        run_cli, forward_consul_port, consul_cluster, default_config,
+        reboot_task, mocker):
+    """An expired window with several nodes is reported as one summary event."""
+    message = "Task /etc/rebootmgr/pre_boot_tasks/00_some_task.sh failed with return code 1"
+    key = chat_escalation_key(message)
+    consul_cluster[0].kv.put(key, json.dumps(
+        {"group": None, "message": message, "since": 0, "nodes": ["consul2", "consul3"]}))
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.run")
+    reboot_task("pre_boot", "00_some_task.sh", exit_code=1)
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 100
+    assert mocked_fire.call_count == 2
+    assert "(on 2 nodes: consul2, consul3)" in mocked_fire.call_args_list[0][0][1]
+    assert "(consul1)" in mocked_fire.call_args_list[1][0][1]
+
+
+def test_chat_escalation_to_file_sink(
+        run_cli, forward_consul_port, consul_cluster, default_config,
+        reboot_task, mocker, tmpdir):
+    """Escalations are delivered to the configured sinks only."""
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.run")
+    reboot_task("pre_boot", "00_some_task.sh", exit_code=1)
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+    path = tmpdir.join("escalations.log")
+
+    result = run_cli(rebootmgr, ["-v", "--escalation-sink", "file:{}".format(path)])
+
+    assert result.exit_code == 100
+    mocked_fire.assert_not_called()
+    escalations = [json.loads(line) for line in path.readlines()]
+    assert len(escalations) == 1
+    assert escalations[0]["hostname"] == "consul1"
+    assert "failed with return code 1" in escalations[0]["body"]
+
+
+def test_chat_escalation_sink_retries(
+        run_cli, forward_consul_port, consul_cluster, default_config,
+        reboot_task, mocker):
+    """A failing sink is retried a bounded number of times."""
+    mocked_sleep = mocker.patch("time.sleep")
+    mocker.patch("subprocess.run")
+    reboot_task("pre_boot", "00_some_task.sh", exit_code=1)
+    mocked_fire = mocker.patch("consul.Consul.Event.fire", side_effect=[Exception("timeout"), None])
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 100
+    assert mocked_fire.call_count == 2
+    mocked_sleep.assert_any_call(2)
+    assert "Failed to fire chat_escalation event" not in result.output
+
+
+def test_chat_escalation_invalid_sink(run_cli, forward_consul_port, default_config):
+    result = run_cli(rebootmgr, ["-v", "--escalation-sink", "carrier-pigeon"])
+
+    assert result.exit_code == 2
+    assert "Invalid escalation sink" in result.output
+
+
+@pytest.fixture
+def webhook_server():
+    """A local HTTP server that records the posted JSON and answers with `status`."""
+    received = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        status = 200
+
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(Handler.status)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.handler = Handler
+    server.received = received
+    server.url = "http://127.0.0.1:{}/escalations".format(server.server_port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_webhook_sink(webhook_server):
+    escalation = make_escalation("consul1", "something broke", "ceph")
+
+    EscalationQueue(None, [WebhookSink(webhook_server.url)], window=0).process(escalation)
+
+    assert webhook_server.received == [escalation]
+
+
+def test_webhook_sink_failure_is_retried_and_logged(webhook_server, mocker, caplog):
+    mocked_sleep = mocker.patch("time.sleep")
+    webhook_server.handler.status = 500
+
+    EscalationQueue(None, [WebhookSink(webhook_server.url)], window=0, retries=2).process(
+        make_escalation("consul1", "something broke"))
+
+    assert len(webhook_server.received) == 3
+    assert [c[0][0] for c in mocked_sleep.call_args_list] == [2, 4]
+    assert "Failed to fire webhook {}: 500 Server Error".format(webhook_server.url) in caplog.text
+
+
+def test_stdout_sink(capsys):
+    escalation = make_escalation("consul1", "something broke")
+
+    EscalationQueue(None, [StdoutSink()], window=0).process(escalation)
+
+    assert json.loads(capsys.readouterr().out) == escalation
+
+
+def test_journal_sink(mocker):
+    mocked_openlog = mocker.patch("syslog.openlog")
+    mocked_syslog = mocker.patch("syslog.syslog")
+
+    EscalationQueue(None, [JournalSink()], window=0).process(make_escalation("consul1", "something broke", "ceph"))
+
+    mocked_openlog.assert_called_once_with("rebootmgr")
+    mocked_syslog.assert_called_once_with(syslog.LOG_WARNING, "(consul1) (ceph) something broke")
+
+
+@pytest.mark.parametrize("spec,sink", [
+    ("consul", ConsulEventSink), ("journal", JournalSink), ("stdout", StdoutSink),
+    ("file:/tmp/escalations", FileSink), ("webhook:http://localhost/", WebhookSink)])
+def test_make_sink(spec, sink):
+    assert isinstance(make_sink(None, spec), sink)
+
+
+@pytest.mark.parametrize("spec", ["consul:x", "journal:x", "stdout:x", "file", "file:", "webhook", "pigeon"])
+def test_make_sink_invalid(spec):
+    with pytest.raises(ValueError, match="Invalid escalation sink"):
+        make_sink(None, spec)
+
+
+def test_escalation_queue_full(caplog):
+    queue = EscalationQueue(None, [], maxsize=1)
+
+    queue.put(make_escalation("consul1", "first"))
+    queue.put(make_escalation("consul1", "second"))
+
+    assert "Escalation queue is full, dropping" in caplog.text
+    assert "second" in caplog.text
+    assert queue.queue.qsize() == 1
+
+
+def test_escalation_queue_close_does_not_wait_forever(caplog):
+    delivered = threading.Event()
+    release = threading.Event()
+
+    class SlowSink:
+        description = "slow"
+
+        def deliver(self, escalation):
+            delivered.set()
+            release.wait(10)
+
+    queue = EscalationQueue(None, [SlowSink()], window=0)
+    queue.start()
+    queue.put(make_escalation("consul1", "something broke"))
+    assert delivered.wait(10)
+
+    queue.close(timeout=0.1)
+
+    assert "Could not deliver all escalations within 0 seconds" in caplog.text
+    release.set()
+    queue.thread.join(10)
+    assert not queue.thread.is_alive()
+
+
+def test_escalation_is_delivered_if_deduplication_fails(mocker, caplog):
+    con = mocker.Mock()
+    con.kv.get.side_effect = Exception("connection refused")
+    sink = mocker.Mock()
+
+    EscalationQueue(con, [sink]).process(make_escalation("consul1", "something broke"))
+
+    sink.deliver.assert_called_once()
+    assert "Could not deduplicate chat escalation: connection refused" in caplog.text
+
+
+def test_escalation_flush_failure_is_logged(mocker, caplog):
+    con = mocker.Mock()
+    con.kv.get.side_effect = Exception("connection refused")
+    sink = mocker.Mock()
+
+    EscalationQueue(con, [sink]).process("flush")
+
+    sink.deliver.assert_not_called()
+    assert "Could not flush chat escalations: connection refused" in caplog.text
+
+
+class MemoryKV:
+    """Just enough of the consul KV store for the rate-limit windows."""
+
+    def __init__(self):
+        self.items = {}
+        self.index = 0
+
+    def get(self, key, recurse=False, consistency=None):
+        if recurse:
+            return None, [dict(item, Key=k) for k, item in self.items.items() if k.startswith(key)] or None
+        return None, self.items.get(key)
+
+    def put(self, key, value, cas=None):
+        item = self.items.get(key)
+        if cas is not None and cas != (item["ModifyIndex"] if item else 0):
+            return False
+        self.index += 1
+        self.items[key] = {"Value": value.encode(), "ModifyIndex": self.index}
+        return True
+
+    def delete(self, key, cas=None):
+        if cas is not None and cas != self.items[key]["ModifyIndex"]:
+            return False
+        del self.items[key]
+        return True
+
+
+def test_escalations_without_node_are_summarized(mocker):
+    con = mocker.Mock()
+    con.kv = MemoryKV()
+    sink = mocker.Mock()
+    queue = EscalationQueue(con, [sink])
+    message = "Unset global stop flag in dc: dc1"
+
+    for _ in range(3):
+        queue.process(make_escalation(None, message))
+    sink.deliver.assert_called_once()
+
+    key = chat_escalation_key(message)
+    record = json.loads(con.kv.items[key]["Value"].decode())
+    assert record["count"] == 3
+    con.kv.put(key, json.dumps(dict(record, since=0)))
+    queue.process("flush")
+
+    assert sink.deliver.call_count == 2
+    assert sink.deliver.call_args[0][0]["body"] == "Unset global stop flag in dc: dc1 (repeated 3 times)"
+    assert key not in con.kv.items
+
+
+def test_single_escalation_without_node_is_not_summarized(mocker):
+    con = mocker.Mock()
+    con.kv = MemoryKV()
+    sink = mocker.Mock()
+    queue = EscalationQueue(con, [sink])
+    message = "Unset global stop flag in dc: dc1"
+
+    queue.process(make_escalation(None, message))
+    key = chat_escalation_key(message)
+    con.kv.put(key, json.dumps(dict(json.loads(con.kv.items[key]["Value"].decode()), since=0)))
+    queue.process("flush")
+
+    sink.deliver.assert_called_once()
@@ -1,3 +1,4 @@
+from rebootmgr import main as rebootmgr_main
 from rebootmgr.main import cli as rebootmgr
 
 import json
@@ -52,3 +53,27 @@ def test_ensure_config_when_invalid(run_cli, forward_consul_port,
     }
 
     assert result.exit_code == 0
+
+
+def test_set_local_stop_flag_keeps_concurrent_update(
+        run_cli, forward_consul_port, consul_cluster, default_config, mocker):
+    hostname = socket.gethostname()
+    key = "service/rebootmgr/nodes/%s/config" % hostname
+    read_config = rebootmgr_main.read_config
+
+    def read_config_and_update_concurrently(con, hostname):
+        result = read_config(con, hostname)
+        if mocked_read_config.call_count == 1:
+            consul_cluster[1].kv.put(key, '{"enabled": true, "group": "ceph"}')
+        return result
+
+    mocked_read_config = mocker.patch("rebootmgr.main.read_config", side_effect=read_config_and_update_concurrently)
+    mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--set-local-stop-flag"])
+
+    assert result.exit_code == 0
+    _, data = consul_cluster[0].kv.get(key)
+    config = json.loads(data["Value"].decode())
+    assert config["enabled"] is False
+    assert config["group"] == "ceph"
@@ -0,0 +1,69 @@
+import json
+
+from rebootmgr.main import cli as rebootmgr
+from rebootmgr.main import explain_host
+
+
+def test_explain_other_hosts(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", '{"enabled": true, "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/reboot_required", "")
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '{"enabled": false, "message": "broken disk", "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul4/config", '{"enabled": true, "tags": ["rack-12"]}')
+    consul_cluster[0].kv.put("service/rebootmgr/tags/rack-12/stop", "rack maintenance")
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", '{"host": "consul3"}')
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr"], check={"TTL": "60s"})
+
+    result = run_cli(rebootmgr, ["--explain", "--hosts", "consul[2-4]", "--hosts", "unknown",
+                                 "--status-format", "json"])
+
+    assert result.exit_code == 0
+    explanations = json.loads(result.output)
+    assert sorted(explanations) == ["consul2", "consul3", "consul4", "unknown"]
+    assert explanations["consul2"]["reboot_required"] is True
+    assert "consul3 is rebooting" in explanations["consul2"]["reasons"]
+    assert any(r.startswith("check Service 'A' check is critical on consul2") for r in explanations["consul2"]["reasons"])
+    assert explanations["consul3"]["post_reboot"] is True
+    assert "node is disabled: broken disk" in explanations["consul3"]["reasons"]
+    assert explanations["consul4"]["reasons"] == ["tag stop flag tags/rack-12/stop is set: rack maintenance"]
+    assert explanations["unknown"]["reasons"] == ["node config is missing or invalid"]
+
+
+def test_explain_this_host(run_cli, forward_consul_port, default_config, consul_cluster):
+    result = run_cli(rebootmgr, ["--explain"])
+
+    assert result.exit_code == 0
+    assert result.output == "consul1 (group -, alive): would reboot if triggered\n"
+
+
+def test_explain_failed_members_of_the_group_only(run_cli, forward_consul_port, consul_cluster, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", '{"enabled": true, "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '{"enabled": true, "group": "compute"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul4/config", '{"enabled": true}')
+
+    def newmembers(self):
+        return [
+            {'Status': 1, 'Name': 'consul1'},
+            {'Status': 1, 'Name': 'consul2'},
+            {'Status': 4, 'Name': 'consul3'},
+            {'Status': 1, 'Name': 'consul4'},
+            {'Status': 4, 'Name': 'consul5'},
+        ]
+
+    mocker.patch("consul.base.Consul.Agent.members", new=newmembers)
+
+    result = run_cli(rebootmgr, ["--explain", "--hosts", "consul[24]", "--status-format", "json"])
+
+    assert result.exit_code == 0
+    explanations = json.loads(result.output)
+    # consul5 has no config, so it counts for every group, like in the cluster check
+    assert explanations["consul2"]["reasons"] == ["consul member consul5 is not alive"]
+    assert explanations["consul4"]["reasons"] == ["consul member consul3 is not alive",
+                                                  "consul member consul5 is not alive"]
+
+
+def test_explain_old_style_config():
+    enabled = explain_host("h", {"disabled": False}, {}, {}, [], [], [])
+    disabled = explain_host("h", {"disabled": True, "message": "broken disk"}, {}, {}, [], [], [])
+
+    assert enabled["reasons"] == []
+    assert disabled["reasons"] == ["node is disabled: broken disk"]
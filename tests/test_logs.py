@@ -0,0 +1,32 @@
+import json
+
+from rebootmgr.main import cli as rebootmgr
+
+
+def test_json_log_format(run_cli, forward_consul_port, default_config, reboot_task, mock_subprocess_run, mocker):
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+
+    result = run_cli(rebootmgr, ["-vv", "--log-format", "json"])
+
+    assert result.exit_code == 0
+    records = [json.loads(line) for line in result.output.splitlines() if line]
+    assert len({r["run_id"] for r in records}) == 1
+    assert {r["hostname"] for r in records} == {"consul1"}
+    assert [r["phase"] for r in records if r["message"] == "Executing pre reboot tasks"] == ["pre_reboot"]
+    assert records[-1]["phase"] == "reboot"
+    assert records[-1]["exit_code"] == 0
+    assert all(isinstance(r["elapsed_ms"], int) for r in records)
+    assert "phase_ms" in records[-1]
+    assert any(r["message"] == "Phase pre_boot_tasks took %i ms" % r["phase_ms"] for r in records)
+
+
+def test_json_log_format_exit_code(run_cli, forward_consul_port, consul_cluster, default_config):
+    consul_cluster[0].kv.put("service/rebootmgr/stop", "reason")
+
+    result = run_cli(rebootmgr, ["-vv", "--log-format", "json"])
+
+    assert result.exit_code == 102
+    record = json.loads(result.output.splitlines()[-1])
+    assert record["message"].startswith("Exit with code 102 in phase startup")
+    assert record["exit_code"] == 102
@@ -1,3 +1,4 @@
+import json
 import pytest
 import socket
 import time
@@ -5,7 +6,8 @@ import time
 from consul import Check
 from rebootmgr.main import cli as rebootmgr
 from rebootmgr.main import EXIT_CONSUL_CHECKS_FAILED, \
-    EXIT_DID_NOT_REALLY_REBOOT
+    EXIT_DID_NOT_REALLY_REBOOT, EXIT_CONSUL_NOT_READY
+from rebootmgr.main import get_boot_id
 from unittest.mock import mock_open
 
 WAIT_UNTIL_HEALTHY_SLEEP_TIME = 120
@@ -119,6 +121,30 @@ def test_post_reboot_wait_until_healthy(
     assert result.exit_code == 0
 
 
+def test_post_reboot_wait_until_healthy_rereads_whitelist(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_in_progress, reboot_task, mocker):
+    """Whitelisting the failing node unblocks a node that waits until the checks pass."""
+    consul_cluster[0].agent.service.register("A", tags=["rebootmgr"])
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr"],
+                                             check=Check.ttl("1000s"))
+    consul_cluster[1].agent.check.ttl_fail("service:A")
+
+    def fake_sleep(seconds):
+        if seconds == WAIT_UNTIL_HEALTHY_SLEEP_TIME:
+            consul_cluster[0].kv.put("service/rebootmgr/ignore_failed_checks", '["consul2"]')
+
+    mocker.patch("time.sleep", new=fake_sleep)
+    mocker.patch("subprocess.run")
+    mocker.patch("subprocess.Popen")
+
+    result = run_cli(rebootmgr, ["-v", "--post-reboot-wait-until-healthy"])
+
+    consul_cluster[0].kv.delete("service/rebootmgr/ignore_failed_checks")
+    assert result.exit_code == 0
+    assert "Trying again in 2 minutes" in result.output
+
+
 def test_post_reboot_phase_fails_without_tasks(
         run_cli, forward_consul_port, default_config, reboot_in_progress):
     result = run_cli(rebootmgr, ["-v"], catch_exceptions=True)
@@ -170,6 +196,22 @@ def test_post_reboot_succeeds_with_current_node_in_maintenance(
     assert result.exit_code == 0
 
 
+def test_post_reboot_ignores_maintenance_of_unrelated_node(
+        run_cli, consul_cluster, reboot_in_progress, forward_consul_port,
+        default_config, reboot_task, mocker):
+    mocker.patch("subprocess.run")
+    consul_cluster[0].agent.service.register("A", tags=["rebootmgr"])
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr"])
+    consul_cluster[3].agent.maintenance(True)
+    full_evaluation = mocker.patch("rebootmgr.main.get_failed_cluster_checks")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert "All consul checks passed." in result.output
+    assert result.exit_code == 0
+    full_evaluation.assert_not_called()
+
+
 def test_post_reboot_fails_with_other_node_in_maintenance(
         run_cli, consul_cluster, reboot_in_progress, forward_consul_port,
         default_config, reboot_task, mocker):
@@ -251,3 +293,138 @@ def test_post_reboot_wait_until_healthy_with_maintenance(
     assert '_node_maintenance on consul2' in result.output
     assert "All consul checks passed." in result.output
     assert result.exit_code == 0
+
+
+def test_post_reboot_only_without_reboot_in_progress(
+        run_cli, forward_consul_port, default_config, reboot_task, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    mocked_popen = reboot_task("pre_boot", "00_some_task.sh")
+
+    result = run_cli(rebootmgr, ["-v", "--post-reboot-only", "--wait-for-consul", "60"])
+
+    assert result.exit_code == 0
+    assert "No reboot of this node is in progress" in result.output
+    mocked_popen.assert_not_called()
+    mocked_run.assert_not_called()
+
+
+def test_post_reboot_only_with_reboot_in_progress(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_in_progress, reboot_task, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    reboot_task("post_boot", "50_another_task.sh")
+
+    result = run_cli(rebootmgr, ["-v", "--post-reboot-only", "--wait-for-consul", "60"])
+
+    assert result.exit_code == 0
+    assert "50_another_task.sh" in result.output
+    mocked_run.assert_not_called()
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+def test_post_reboot_only_when_post_reboot_finished_before_lock(
+        run_cli, forward_consul_port, default_config, reboot_in_progress, reboot_task, mocker):
+    """Another run finishes the post reboot phase while this one waits for the lock."""
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    mocked_popen = reboot_task("pre_boot", "00_some_task.sh")
+    hostname = socket.gethostname().split(".")[0]
+    mocker.patch("rebootmgr.main.check_reboot_in_progress", side_effect=[hostname, ""])
+
+    result = run_cli(rebootmgr, ["-v", "--post-reboot-only", "--wait-for-consul", "60"])
+
+    assert result.exit_code == 0
+    assert "No reboot of this node is in progress" in result.output
+    mocked_popen.assert_not_called()
+    mocked_run.assert_not_called()
+
+
+def test_post_reboot_waits_for_consul(
+        run_cli, forward_consul_port, default_config, reboot_in_progress,
+        reboot_task, mocker):
+    mocker.patch("time.sleep")
+    mocker.patch("consul.base.Consul.Status.leader", side_effect=[ConnectionError, "", "10.0.0.1:8300"])
+    reboot_task("post_boot", "50_another_task.sh")
+
+    result = run_cli(rebootmgr, ["-v", "--post-reboot-only", "--wait-for-consul", "60"])
+
+    assert result.exit_code == 0
+
+
+def test_post_reboot_consul_not_ready(run_cli, mocker):
+    mocked_time = mocker.patch("rebootmgr.main.time")
+    mocked_time.time.side_effect = [0, 61]
+    mocker.patch("consul.base.Consul.Status.leader", return_value="")
+
+    result = run_cli(rebootmgr, ["-v", "--post-reboot-only", "--wait-for-consul", "60"])
+
+    assert "Consul is not ready after 60 seconds" in result.output
+    assert result.exit_code == EXIT_CONSUL_NOT_READY
+
+
+def test_post_reboot_phase_fails_with_same_boot_id(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mocker):
+    hostname = socket.gethostname().split(".")[0]
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", "{} {}".format(hostname, get_boot_id()))
+    mocker.patch("subprocess.run")
+    mocked_popen = reboot_task("post_boot", "50_another_task.sh")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert "We are in post reboot state but the node did not reboot yet" in result.output
+    assert result.exit_code == EXIT_DID_NOT_REALLY_REBOOT
+    mocked_popen.assert_not_called()
+
+
+def test_post_reboot_phase_succeeds_with_new_boot_id_and_uptime(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mocker):
+    """With a boot id, a long uptime (slow host) does not matter."""
+    hostname = socket.gethostname().split(".")[0]
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", "{} some-old-boot-id".format(hostname))
+    mocker.patch("rebootmgr.main.uptime", return_value=99999999.9)
+    mocker.patch("subprocess.run")
+    reboot_task("post_boot", "50_another_task.sh")
+
+    result = run_cli(rebootmgr, ["-v", "--check-uptime"])
+
+    assert result.exit_code == 0
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+def test_post_reboot_phase_is_recorded(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mocker):
+    hostname = socket.gethostname().split(".")[0]
+    record = {"host": hostname, "boot_id": "some-old-boot-id", "phase": "rebooting",
+              "started": time.time() - 300, "updated": time.time() - 300,
+              "expected_duration": 3600, "session": None}
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", json.dumps(record))
+    mocker.patch("subprocess.run")
+    reboot_task("post_boot", "50_another_task.sh", exit_code=1)
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 100
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    record = json.loads(data["Value"].decode())
+    assert record["phase"] == "post_boot"
+    assert record["boot_id"] == "some-old-boot-id"
+
+
+def test_reboot_fails_if_another_reboot_with_record_is_in_progress(
+        run_cli, consul_cluster, forward_consul_port, default_config):
+    record = {"host": "consul2", "boot_id": "some-boot-id", "phase": "rebooting",
+              "started": time.time() - 600, "updated": time.time() - 600,
+              "expected_duration": 3600, "session": None}
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", json.dumps(record))
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert "Another Node consul2 (rebooting, started 10 minutes ago) is rebooting" in result.output
+    assert result.exit_code == 4
@@ -0,0 +1,80 @@
+import json
+import socket
+
+from rebootmgr.main import cli as rebootmgr
+
+
+def test_preflight_passes(run_cli, forward_consul_port, default_config, consul_cluster, mocker):
+    mocked_sleep = mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    mocked_popen = mocker.patch("subprocess.Popen")
+
+    result = run_cli(rebootmgr, ["--preflight"])
+
+    assert result.exit_code == 0
+    for gate in ["config", "cluster", "lock", "holidays", "stop_flag", "disabled", "triggers", "services"]:
+        assert gate in result.output
+    assert "FAIL" not in result.output
+    mocked_sleep.assert_not_called()
+    mocked_run.assert_not_called()
+    mocked_popen.assert_not_called()
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+def test_preflight_reports_all_failed_gates(run_cli, forward_consul_port, default_config, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/stop", "incident")
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", '{"host": "consul2"}')
+
+    result = run_cli(rebootmgr, ["--preflight", "--check-triggers", "--status-format", "json"])
+
+    # The lock is checked before the stop flag, like in a real run
+    assert result.exit_code == 4
+    gates = json.loads(result.output)
+    assert gates["stop_flag"]["passed"] is False
+    assert gates["stop_flag"]["detail"] == "service/rebootmgr/stop (global scope)"
+    assert gates["triggers"]["passed"] is False
+    assert gates["lock"]["exit_code"] == 4
+    assert "consul2" in gates["lock"]["detail"]
+    assert gates["config"]["passed"] is True
+    assert all("ms" in gate for gate in gates.values())
+
+
+def test_preflight_does_not_migrate_config(run_cli, forward_consul_port, default_config, consul_cluster):
+    hostname = socket.gethostname()
+    key = "service/rebootmgr/nodes/%s/config" % hostname
+    consul_cluster[0].kv.put(key, '{"disabled": false}')
+
+    result = run_cli(rebootmgr, ["--preflight", "--status-format", "json"])
+
+    assert result.exit_code == 0
+    assert json.loads(result.output)["disabled"]["detail"] == "enabled"
+    _, data = consul_cluster[0].kv.get(key)
+    assert json.loads(data["Value"].decode()) == {"disabled": False}
+
+
+def test_preflight_exits_like_a_missing_config(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/stop", "incident")
+
+    result = run_cli(rebootmgr, ["--preflight", "--status-format", "json"])
+
+    consul_cluster[0].kv.delete("service/rebootmgr", recurse=True)
+    assert result.exit_code == 104
+    assert json.loads(result.output)["stop_flag"]["passed"] is False
+
+
+def test_preflight_exits_like_a_failed_cluster_without_trigger(
+        run_cli, forward_consul_port, default_config, consul_cluster, mocker):
+    def newmembers(self):
+        return [
+            {'Status': 1, 'Name': 'consul1'},
+            {'Status': 4, 'Name': 'consul2'},
+        ]
+
+    mocker.patch("consul.base.Consul.Agent.members", new=newmembers)
+
+    result = run_cli(rebootmgr, ["--preflight", "--check-triggers", "--status-format", "json"])
+
+    assert result.exit_code == 3
+    gates = json.loads(result.output)
+    assert gates["triggers"]["passed"] is False
@@ -1,6 +1,12 @@
+import consul
+import json
+import pytest
 import socket
+import subprocess
 
+import rebootmgr.main as rebootmgr_main
 from rebootmgr.main import cli as rebootmgr
+from rebootmgr.main import get_boot_id
 from rebootmgr.main import EXIT_CONSUL_LOCK_FAILED, \
     EXIT_CONSUL_CHECKS_FAILED, EXIT_CONFIGURATION_IS_MISSING
 
@@ -39,9 +45,14 @@ def test_reboot_succeeds_with_tasks(run_cli, forward_consul_port, consul_cluster
     # so that we can notice when the tasks broke some consul checks.
     mocked_sleep.assert_any_call(130)
 
-    # Check that it sets the reboot_in_progress flag
+    # Check that it sets the reboot_in_progress flag, with the current boot id
     _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
-    assert data["Value"].decode() == socket.gethostname()
+    record = json.loads(data["Value"].decode())
+    assert record["host"] == socket.gethostname()
+    assert record["boot_id"] == get_boot_id()
+    assert record["phase"] == "rebooting"
+    assert record["expected_duration"] == 60 * 60
+    assert record["session"]
 
 
 def test_dryrun_reboot_succeeds_with_tasks(run_cli, forward_consul_port,
@@ -166,3 +177,119 @@ def test_reboot_succeeds_if_another_node_is_in_maintenance_but_ignoring(
     mocked_popen.assert_not_called()
     mocked_run.assert_any_call(["shutdown", "-r", "+1"], check=True)
     assert result.exit_code == 0
+
+
+def test_reboot_skips_full_check_evaluation_if_healthy(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mock_subprocess_run, mocker):
+    consul_cluster[0].agent.service.register("A", tags=["rebootmgr"])
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr"])
+
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+    spy = mocker.spy(rebootmgr_main, "get_failed_cluster_checks")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+    spy.assert_not_called()
+
+
+def test_reboot_evaluates_all_checks_with_min_passing(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mock_subprocess_run, mocker):
+    consul_cluster[0].agent.service.register("A", tags=["rebootmgr", "min_passing=3"])
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr", "min_passing=3"])
+
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+    spy = mocker.spy(rebootmgr_main, "get_failed_cluster_checks")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert spy.call_count > 0
+    assert result.exit_code == EXIT_CONSUL_CHECKS_FAILED
+
+
+def test_reboot_with_stale_reads(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mock_subprocess_run, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mock_subprocess_run(["shutdown", "-r", "+1"])
+    spy = mocker.spy(consul.Consul.KV, "get")
+
+    result = run_cli(rebootmgr, ["-v", "--consul-stale-reads"])
+
+    assert result.exit_code == 0
+    mocked_run.assert_any_call(["shutdown", "-r", "+1"], check=True)
+    consistency = {c[0][1]: c[1].get("consistency") for c in spy.call_args_list}
+    assert consistency["service/rebootmgr/reboot_in_progress"] == "consistent"
+    assert consistency["service/rebootmgr/nodes/consul1/config"] == "default"
+    assert consistency["service/rebootmgr/ignore_failed_checks"] is None
+    assert spy.call_args_list[0][0][0].agent.consistency == "stale"
+
+
+def test_reboot_with_delay_from_command_line(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mock_subprocess_run, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/config", '{"reboot_delay": 10}')
+    mocker.patch("time.sleep")
+    mocked_run = mock_subprocess_run(["shutdown", "-r", "+5"])
+
+    result = run_cli(rebootmgr, ["-v", "--reboot-delay", "5"])
+
+    assert result.exit_code == 0
+    mocked_run.assert_any_call(["shutdown", "-r", "+5"], check=True)
+
+
+def test_reboot_with_kexec_from_group_config(
+        run_cli, forward_consul_port, consul_cluster,
+        reboot_task, mock_subprocess_run, mocker):
+    hostname = socket.gethostname().split(".")[0]
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/{}/config".format(hostname), '{"enabled": true, "group": "compute"}')
+    consul_cluster[0].kv.put("service/rebootmgr/compute_config", '{"reboot_method": "kexec", "reboot_delay": 0}')
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["kexec", "--load", "/boot/vmlinuz", "--initrd=/boot/initrd.img", "--reuse-cmdline"])
+    mocked_run = mock_subprocess_run(["systemctl", "kexec"])
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+    mocked_run.assert_any_call(["systemctl", "kexec"], check=True)
+    consul_cluster[0].kv.delete("service/rebootmgr", recurse=True)
+
+
+@pytest.mark.parametrize("group_config", ['{"reboot_method": "kexek"}', '{"reboot_delay": -1}',
+                                          '{"reboot_delay": "abc"}', '{"reboot_delay": 1.5}',
+                                          '{"reboot_timeout": "abc"}', '{"reboot_timeout": 0}'])
+def test_reboot_with_invalid_group_config(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mocker, group_config):
+    consul_cluster[0].kv.put("service/rebootmgr/config", group_config)
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    mocked_popen = reboot_task("pre_boot", "00_some_task.sh")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 104
+    assert "in the group configuration" in result.output
+    mocked_popen.assert_not_called()
+    mocked_run.assert_not_called()
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+def test_reboot_with_kexec_falls_back_to_shutdown(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mock_subprocess_run, mocker):
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["kexec", "--load", "/boot/vmlinuz", "--initrd=/boot/initrd.img", "--reuse-cmdline"],
+                        side_effect=subprocess.CalledProcessError(1, "kexec"))
+    mocked_run = mock_subprocess_run(["shutdown", "-r", "+1"])
+
+    result = run_cli(rebootmgr, ["-v", "--reboot-method", "kexec"])
+
+    assert result.exit_code == 0
+    assert "Could not load /boot/vmlinuz for kexec" in result.output
+    mocked_run.assert_any_call(["shutdown", "-r", "+1"], check=True)
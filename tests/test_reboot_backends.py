@@ -0,0 +1,78 @@
+import json
+import pytest
+import socket
+
+from rebootmgr.backends import BACKENDS
+from rebootmgr.backends import RecordingBackend
+from rebootmgr.main import cli as rebootmgr
+
+
+@pytest.fixture
+def recorded_reboots(mocker):
+    mocker.patch.dict(BACKENDS, {"recorder": RecordingBackend})
+    RecordingBackend.reboots = []
+    yield RecordingBackend.reboots
+    RecordingBackend.reboots = []
+
+
+def test_reboot_with_systemctl(
+        run_cli, forward_consul_port, default_config, reboot_task,
+        mock_subprocess_run, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mock_subprocess_run(
+        ["systemd-run", "--on-active=1m", "--timer-property=AccuracySec=1s", "systemctl", "reboot"])
+
+    result = run_cli(rebootmgr, ["-v", "--reboot-method", "systemctl"])
+
+    assert result.exit_code == 0
+    assert mocked_run.call_count == 1
+
+
+def test_reboot_with_unknown_method_in_group_config(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/config", '{"reboot_method": "magic"}')
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+
+    result = run_cli(rebootmgr, ["-v"], catch_exceptions=True)
+
+    assert result.exit_code == 1
+    assert isinstance(result.exception, ValueError)
+    mocked_run.assert_not_called()
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+def test_rolling_reboot_simulation_with_recorder(
+        run_cli, forward_consul_port, default_config, consul_cluster,
+        reboot_task, recorded_reboots, mocker):
+    """Reboot and come back a few times, without rebooting for real."""
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+
+    consul_cluster[0].kv.put("service/rebootmgr/config", '{"reboot_method": "recorder", "reboot_delay": 0}')
+
+    for i in range(3):
+        result = run_cli(rebootmgr, ["-v"])
+        assert result.exit_code == 0
+        _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+        record = json.loads(data["Value"].decode())
+        assert record["host"] == socket.gethostname()
+        assert record["reboot_method"] == "recorder"
+
+        # After the reboot
+        result = run_cli(rebootmgr, ["-v"])
+        assert result.exit_code == 0
+        _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+        assert data is None
+
+    mocked_run.assert_not_called()
+    assert [r["delay"] for r in recorded_reboots] == [0, 0, 0]
+
+
+def test_recorder_is_not_a_reboot_method(run_cli, forward_consul_port, default_config):
+    result = run_cli(rebootmgr, ["-v", "--reboot-method", "recorder"])
+
+    assert result.exit_code == 2
+    assert "Invalid value for '--reboot-method'" in result.output
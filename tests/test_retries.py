@@ -0,0 +1,99 @@
+import logging
+import threading
+
+import pytest
+import requests
+from consul.base import ClientError, ConsulException
+
+from rebootmgr import retries
+
+
+@pytest.fixture
+def failing(mocker):
+    mocker.patch("time.sleep")
+    retries.reset(budget=5)
+
+    def make(exception):
+        func = mocker.Mock(side_effect=exception, __name__="read")
+        return func, retries.consul_retry(func)
+
+    yield make
+    retries.reset()
+
+
+@pytest.mark.parametrize("exception", [ValueError("bug"), ClientError("409 conflict"), ConsulException("no leader")])
+def test_no_retry_on_permanent_errors(failing, exception):
+    func, retried = failing(exception)
+
+    with pytest.raises(type(exception)):
+        retried()
+
+    assert func.call_count == 1
+    assert retries.STATS["retries"] == {}
+
+
+@pytest.mark.parametrize("exception", [ConsulException("500 No cluster leader"), requests.exceptions.ConnectionError()])
+def test_retry_on_transient_errors(failing, exception):
+    func, retried = failing([exception, exception, "value"])
+
+    assert retried() == "value"
+
+    assert func.call_count == 3
+    assert retries.STATS["retries"] == {"read": 2}
+
+
+def test_retry_budget(failing):
+    func, retried = failing(ConsulException("503 unavailable"))
+
+    with pytest.raises(ConsulException):
+        retried()
+    with pytest.raises(ConsulException):
+        retried()
+
+    # The budget is shared by all calls of the run
+    assert func.call_count == 5 + 2
+    assert retries.STATS == {"retries": {"read": 5}, "gave_up": 2, "budget_exhausted": 2}
+
+
+def test_wait_grows_with_jitter():
+    for attempt in range(1, 8):
+        wait = min(retries.WAIT_MAX_MS, retries.WAIT_BASE_MS * 2 ** (attempt - 1))
+        assert wait / 2 <= retries.wait_ms(attempt) <= wait
+
+
+def test_retry_budget_exhausted_is_logged(failing, caplog):
+    _, retried = failing(ConsulException("503 unavailable"))
+
+    with pytest.raises(ConsulException):
+        retried()
+
+    assert "Retry budget of the run is exhausted, not retrying read: 503 unavailable" in caplog.text
+
+
+def test_own_retry_budget_of_thread(failing):
+    _, retried = failing(ConsulException("503 unavailable"))
+
+    def watcher():
+        retries.use_own_budget(budget=3)
+        with pytest.raises(ConsulException):
+            retried()
+
+    thread = threading.Thread(target=watcher)
+    thread.start()
+    thread.join()
+
+    # The thread used up its own budget, not the one of the run
+    assert retries.STATS["retries"] == {"read": 3}
+    assert retries._remaining() == 5
+
+
+def test_log_stats(failing, caplog):
+    caplog.set_level(logging.INFO)
+    retries.log_stats()
+    assert "Retries" not in caplog.text
+
+    _, retried = failing([ConsulException("500 No cluster leader"), "value"])
+    retried()
+    retries.log_stats()
+
+    assert "Retries: read=1, gave up: 0, budget exhausted: 0" in caplog.text
@@ -0,0 +1,86 @@
+import json
+
+from rebootmgr.main import cli as rebootmgr
+
+
+def test_status_json(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/stop", "global reason")
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_stop", "group reason")
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", '{"host": "consul2", "phase": "rebooting"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", '{"enabled": true, "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/reboot_required", "")
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '{"enabled": false, "message": "broken disk", "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul4/config", '{"enabled": true}')
+
+    result = run_cli(rebootmgr, ["--status", "--status-format", "json"])
+
+    assert result.exit_code == 0
+    status = json.loads(result.output)
+    assert status["global_stop_flag"] == "global reason"
+    ceph = status["groups"]["ceph"]
+    assert ceph["stop_flag"] == "group reason"
+    assert ceph["reboot_in_progress"]["host"] == "consul2"
+    assert ceph["reboot_in_progress"]["member_status"] == "alive"
+    assert ceph["nodes"] == 2
+    assert ceph["reboot_required"] == ["consul2"]
+    assert ceph["disabled"] == {"consul3": "broken disk"}
+    assert status["groups"][""]["nodes"] == 1
+
+
+def test_status_table(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '{"enabled": false, "message": "broken disk", "group": "ceph"}')
+
+    result = run_cli(rebootmgr, ["--status"])
+
+    assert result.exit_code == 0
+    assert "Global stop flag: -" in result.output
+    assert "Disabled: consul3 (ceph): broken disk" in result.output
+
+
+def test_status_with_malformed_keys(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/foo/", None)
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/bar", "x")
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/baz/config/old", "x")
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", "[]")
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '"x"')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul4/config", '{"enabled": true, "group": "ceph"}')
+
+    result = run_cli(rebootmgr, ["--status", "--status-format", "json"])
+
+    assert result.exit_code == 0
+    status = json.loads(result.output)
+    # Configs that are no objects count like invalid ones
+    assert status["groups"][""]["nodes"] == 2
+    assert status["groups"][""]["unconfigured"] == ["consul2", "consul3"]
+    assert status["groups"]["ceph"]["nodes"] == 1
+
+
+def test_status_with_old_and_incomplete_configs(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", '{"disabled": true, "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '{"group": "ceph"}')
+
+    result = run_cli(rebootmgr, ["--status"])
+
+    assert result.exit_code == 0
+    assert "Disabled: consul2 (ceph): " in result.output
+    assert "Missing or invalid config: consul3 (ceph)" in result.output
+
+
+def test_status_with_node_and_tag_stop_flags(run_cli, forward_consul_port, consul_cluster):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", '{"enabled": true, "group": "ceph"}')
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/stop", "bad disk")
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul3/config", '{"enabled": true, "tags": ["gpu"]}')
+    consul_cluster[0].kv.put("service/rebootmgr/tags/gpu/stop", "driver update")
+
+    result = run_cli(rebootmgr, ["--status", "--status-format", "json"])
+
+    assert result.exit_code == 0
+    status = json.loads(result.output)
+    assert status["tag_stop_flags"] == {"gpu": "driver update"}
+    assert status["groups"]["ceph"]["stopped"] == {"consul2": "nodes/consul2/stop: bad disk"}
+    assert status["groups"][""]["stopped"] == {"consul3": "tags/gpu/stop: driver update"}
+
+    result = run_cli(rebootmgr, ["--status"])
+
+    assert "Tag stop flag gpu: driver update" in result.output
+    assert "Stopped: consul2 (ceph): nodes/consul2/stop: bad disk" in result.output
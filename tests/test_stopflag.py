@@ -1,7 +1,10 @@
 import json
+import pytest
 import socket
 
 from rebootmgr.main import cli as rebootmgr
+from rebootmgr.main import select_node_configs
+from rebootmgr.main import update_node_configs
 
 
 def test_not_verbose(run_cli, consul_cluster, forward_consul_port, default_config):
@@ -164,3 +167,158 @@ def test_unset_local_stop_flag(
     config = json.loads(data["Value"].decode())
     assert config['enabled'] is True
     assert result.exit_code == 0
+
+
+def test_set_local_stop_flag_of_many_hosts(
+        run_cli, forward_consul_port, consul_cluster, tmp_path, mocker):
+    for i in range(100):
+        group = "ceph" if i % 2 else "compute"
+        consul_cluster[0].kv.put("service/rebootmgr/nodes/node-{:03}/config".format(i),
+                                 json.dumps({"enabled": True, "group": group}))
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/other/config", '{"enabled": true, "group": "ceph"}')
+    hosts_file = tmp_path / "hosts"
+    hosts_file.write_text("# incident\nother\n")
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--set-local-stop-flag", "--hosts", "node-*", "--hosts-from", str(hosts_file),
+                                 "--group", "ceph", "--stop-reason", "incident"])
+
+    assert result.exit_code == 0
+    assert "Set local stop flag on 51 nodes" in result.output
+    mocked_fire.assert_called_once()
+    _, items = consul_cluster[0].kv.get("service/rebootmgr/nodes/", recurse=True)
+    configs = {item["Key"].split("/")[3]: json.loads(item["Value"].decode()) for item in items}
+    for host, config in configs.items():
+        assert config["enabled"] is (config["group"] != "ceph")
+        if config["group"] == "ceph":
+            assert "incident" in config["message"]
+
+    result = run_cli(rebootmgr, ["-v", "--unset-local-stop-flag", "--hosts", "group:ceph"])
+
+    assert result.exit_code == 0
+    _, items = consul_cluster[0].kv.get("service/rebootmgr/nodes/", recurse=True)
+    assert all(json.loads(item["Value"].decode())["enabled"] for item in items)
+
+
+def test_set_local_stop_flag_of_no_hosts(run_cli, forward_consul_port, consul_cluster):
+    result = run_cli(rebootmgr, ["-v", "--set-local-stop-flag", "--hosts", "does-not-exist-*"])
+
+    assert result.exit_code == 7
+    assert "No node configs match does-not-exist-*" in result.output
+
+
+def test_hosts_need_an_action(run_cli):
+    result = run_cli(rebootmgr, ["-v", "--hosts", "node-*"])
+
+    assert result.exit_code == 2
+    assert "--hosts and --hosts-from need --set-local-stop-flag" in result.output
+
+
+@pytest.mark.parametrize("action", ["--set-local-stop-flag", "--unset-local-stop-flag"])
+def test_group_needs_hosts(run_cli, forward_consul_port, default_config, consul_cluster, action):
+    hostname = socket.gethostname()
+
+    result = run_cli(rebootmgr, ["-v", action, "--group", "ceph"])
+
+    assert result.exit_code == 2
+    assert "--hosts 'group:ceph'" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/nodes/{}/config".format(hostname))
+    assert json.loads(data["Value"].decode()) == {"enabled": True}
+
+
+def test_update_node_configs_retries_on_conflict(consul_cluster):
+    for host in ["node-a", "node-b", "node-c"]:
+        consul_cluster[0].kv.put("service/rebootmgr/nodes/{}/config".format(host), '{"enabled": true}')
+    items = select_node_configs(consul_cluster[0], ["node-*"])
+    calls = []
+
+    def update(hostname, config):
+        if not calls:
+            # Another writer changes one config and deletes another one before the transaction
+            consul_cluster[1].kv.put("service/rebootmgr/nodes/node-b/config", '{"enabled": true, "group": "ceph"}')
+            consul_cluster[1].kv.delete("service/rebootmgr/nodes/node-c/config")
+        calls.append(hostname)
+        config["enabled"] = False
+
+    updated = update_node_configs(consul_cluster[0], items, update)
+
+    assert updated == ["node-a", "node-b"]
+    assert calls == ["node-a", "node-b", "node-c", "node-a", "node-b"]
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/nodes/node-b/config")
+    assert json.loads(data["Value"].decode()) == {"enabled": False, "group": "ceph"}
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/nodes/node-c/config")
+    assert data is None
+
+
+def test_set_global_stop_flag_in_all_datacenters(
+        run_cli, forward_consul_port, consul_cluster, mocker):
+    mocker.patch("consul.Consul.Event.fire")
+    datacenters = consul_cluster[0].catalog.datacenters()
+
+    result = run_cli(rebootmgr, ["-v", "--set-global-stop-flag", "all"])
+
+    assert result.exit_code == 0
+    for dc in datacenters:
+        assert "Done in dc " + dc in result.output
+        _, data = consul_cluster[0].kv.get("service/rebootmgr/stop", dc=dc)
+        assert data["Value"]
+
+    result = run_cli(rebootmgr, ["-v", "--unset-global-stop-flag", "all"])
+
+    assert result.exit_code == 0
+    for dc in datacenters:
+        _, data = consul_cluster[0].kv.get("service/rebootmgr/stop", dc=dc)
+        assert data is None
+
+
+@pytest.mark.parametrize("args", [["--set-global-stop-flag", " , "], ["--unset-global-stop-flag", ","],
+                                  ["--set-global-stop-flag", "all"]])
+def test_global_stop_flag_without_datacenters(run_cli, mocker, args):
+    mocker.patch("consul.base.Consul.Catalog.datacenters", return_value=[])
+    mocked_put = mocker.patch("consul.base.Consul.KV.put")
+    mocked_delete = mocker.patch("consul.base.Consul.KV.delete")
+
+    result = run_cli(rebootmgr, ["-v"] + args)
+
+    assert result.exit_code == 7
+    assert "No datacenters in" in result.output
+    mocked_put.assert_not_called()
+    mocked_delete.assert_not_called()
+
+
+def test_set_global_stop_flag_with_unknown_datacenter(
+        run_cli, forward_consul_port, consul_cluster, mocker):
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--set-global-stop-flag", "test,unknown-dc"])
+
+    assert result.exit_code == 7
+    assert "Failed in dc unknown-dc" in result.output
+    assert "Could not set the global stop flag in dc: unknown-dc" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/stop", dc="test")
+    assert data["Value"]
+    assert "in dc: test" in mocked_fire.call_args[0][1]
+
+
+@pytest.mark.parametrize("stop_flag,scope", [
+    ("service/rebootmgr/nodes/{hostname}/stop", "node"),
+    ("service/rebootmgr/tags/rack-12/stop", "tag"),
+    ("service/rebootmgr/ceph_stop", "group"),
+])
+def test_reboot_fails_with_node_tag_or_group_stop_flag(
+        run_cli, forward_consul_port, consul_cluster, reboot_task,
+        mock_subprocess_run, mocker, stop_flag, scope):
+    hostname = socket.gethostname().split(".")[0]
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/{}/config".format(hostname),
+                             '{"enabled": true, "group": "ceph", "tags": ["ssd", "rack-12"]}')
+    consul_cluster[0].kv.put(stop_flag.format(hostname=hostname), "maintenance of rack 12")
+    mocker.patch("time.sleep")
+    mocked_run = mock_subprocess_run(["shutdown", "-r", "+1"])
+    mocked_popen = mocker.patch("subprocess.Popen")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    mocked_run.assert_not_called()
+    mocked_popen.assert_not_called()
+    assert "Stop flag is set: exit ({}, {} scope)".format(stop_flag.format(hostname=hostname), scope) in result.output
+    assert result.exit_code == 102
@@ -1,6 +1,19 @@
 import json
+import os
+import signal
 import socket
+import subprocess
+import sys
+import threading
 
+import pytest
+
+from rebootmgr.main import StopFlagWatcher
+from rebootmgr.main import discover_tasks
+from rebootmgr.main import read_task_metadata
+from rebootmgr.main import run_rollback_tasks
+from rebootmgr.main import task_command
+from rebootmgr.main import validate_task
 from rebootmgr.main import cli as rebootmgr
 
 
@@ -73,3 +86,232 @@ def test_post_reboot_phase_task_timeout(run_cli, consul_cluster, forward_consul_
     }
     assert mocked_popen.call_count == 1
     mocked_run.assert_not_called()
+
+
+def test_stop_flag_aborts_pre_boot_tasks(
+        run_cli, consul_cluster, forward_consul_port, default_config, reboot_task,
+        mock_subprocess_popen, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    terminated = threading.Event()
+    mocker.patch.object(StopFlagWatcher, "_terminate", autospec=True,
+                        side_effect=lambda watcher, process: terminated.set())
+
+    def set_stop_flag_and_wait(timeout):
+        consul_cluster[0].kv.put("service/rebootmgr/stop", "incident")
+        assert terminated.wait(30)
+        return -15
+
+    reboot_task("pre_boot", "00_some_task.sh")
+    reboot_task("pre_boot", "10_another_task.sh")
+    mock_subprocess_popen(["/etc/rebootmgr/pre_boot_tasks/00_some_task.sh"], wait_side_effect=set_stop_flag_and_wait)
+    reboot_task("pre_boot_rollback", "00_some_task.sh")
+    mocked_popen = reboot_task("pre_boot_rollback", "10_another_task.sh")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert "Stop flag service/rebootmgr/stop (global scope) was set, " \
+           "aborted task /etc/rebootmgr/pre_boot_tasks/00_some_task.sh" in result.output
+    assert result.exit_code == 102
+    assert [c[0][0] for c in mocked_popen.call_args_list] == [
+        "/etc/rebootmgr/pre_boot_tasks/00_some_task.sh",
+        "/etc/rebootmgr/pre_boot_rollback_tasks/00_some_task.sh",
+    ]
+    mocked_run.assert_not_called()
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+@pytest.fixture
+def running_task():
+    """Start a task that is ready once it printed a line, optionally ignoring SIGTERM."""
+    processes = []
+
+    def start(ignore_sigterm):
+        code = "import signal, time\n"
+        if ignore_sigterm:
+            code += "signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+        code += "print('ready', flush=True)\ntime.sleep(600)\n"
+        process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE)
+        processes.append(process)
+        assert process.stdout.readline() == b"ready\n"
+        return process
+
+    yield start
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        process.stdout.close()
+
+
+@pytest.mark.parametrize("ignore_sigterm,returncode", [(False, -signal.SIGTERM), (True, -signal.SIGKILL)])
+def test_stop_flag_watcher_terminates_task(running_task, caplog, ignore_sigterm, returncode):
+    watcher = StopFlagWatcher(None, None, "consul1", kill_after=1)
+    watcher.stop_flag = ("service/rebootmgr/stop", "global")
+    process = running_task(ignore_sigterm)
+
+    # A stop flag is already set, so the task is terminated right away
+    watcher.set_process(process)
+
+    assert process.wait(timeout=10) == returncode
+    assert ("Task did not terminate within 1 seconds, killing it" in caplog.text) == ignore_sigterm
+
+
+def test_failed_pre_boot_task_rolls_back_finished_tasks(
+        run_cli, consul_cluster, forward_consul_port, default_config, reboot_task, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    reboot_task("pre_boot", "00_disable_compute.sh")
+    reboot_task("pre_boot", "10_evacuate.sh")
+    reboot_task("pre_boot", "20_fails.sh", exit_code=1)
+    reboot_task("pre_boot_rollback", "00_disable_compute.sh")
+    reboot_task("pre_boot_rollback", "10_evacuate.sh")
+    mocked_popen = reboot_task("pre_boot_rollback", "20_fails.sh")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert "Task /etc/rebootmgr/pre_boot_tasks/20_fails.sh failed with return code 1" in result.output
+    assert result.exit_code == 100
+    assert [c[0][0] for c in mocked_popen.call_args_list] == [
+        "/etc/rebootmgr/pre_boot_tasks/00_disable_compute.sh",
+        "/etc/rebootmgr/pre_boot_tasks/10_evacuate.sh",
+        "/etc/rebootmgr/pre_boot_tasks/20_fails.sh",
+        "/etc/rebootmgr/pre_boot_rollback_tasks/10_evacuate.sh",
+        "/etc/rebootmgr/pre_boot_rollback_tasks/00_disable_compute.sh",
+    ]
+    mocked_run.assert_not_called()
+
+
+def test_task_metadata(tmp_path):
+    task = tmp_path / "10_drain.sh"
+    task.write_text("#!/bin/sh\n"
+                    "# rebootmgr: timeout=30, retries=2 backoff=5\n"
+                    "# rebootmgr: cpu_quota=50% memory_max=1G nice=10 colour=blue\n"
+                    "drain\n")
+
+    metadata = read_task_metadata(str(task))
+
+    assert metadata == {"timeout": 30, "retries": 2, "backoff": 5, "cpu_quota": "50%", "memory_max": "1G", "nice": 10}
+    assert task_command(str(task), metadata) == [
+        "systemd-run", "--scope", "--quiet", "--collect",
+        "--property=CPUQuota=50%", "--property=MemoryMax=1G", "--nice=10", str(task)]
+    assert task_command(str(task), {"nice": 5}) == ["nice", "-n", "5", str(task)]
+    assert task_command(str(task), {}) == str(task)
+    assert read_task_metadata(str(tmp_path / "missing.sh")) == {}
+
+
+def test_task_metadata_timeout_zero(tmp_path, caplog):
+    task = tmp_path / "10_drain.sh"
+    task.write_text("#!/bin/sh\n# rebootmgr: timeout=0 retries=0\n")
+
+    assert read_task_metadata(str(task)) == {"retries": 0}
+    assert "Ignoring invalid setting timeout=0 of task {}".format(task) in caplog.text
+
+
+def test_task_is_retried(run_cli, consul_cluster, forward_consul_port, default_config, reboot_task,
+                         mock_subprocess_popen, mocker):
+    mocked_sleep = mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    mocker.patch("rebootmgr.main.read_task_metadata", return_value={"retries": 2, "backoff": 3})
+    reboot_task("pre_boot", "00_flaky_task.sh")
+    mocked_popen = mock_subprocess_popen(["/etc/rebootmgr/pre_boot_tasks/00_flaky_task.sh"],
+                                         wait_side_effect=iter([1, 1, 0]))
+
+    result = run_cli(rebootmgr, ["-v", "--dryrun"])
+
+    assert result.exit_code == 0
+    assert mocked_popen.call_count == 3
+    assert "failed with return code 1, retry in 3 seconds" in result.output
+    assert "failed with return code 1, retry in 6 seconds" in result.output
+    mocked_sleep.assert_any_call(3)
+    mocked_sleep.assert_any_call(6)
+    mocked_run.assert_not_called()
+
+
+def test_invalid_tasks_fail_before_locking(
+        run_cli, consul_cluster, forward_consul_port, default_config, reboot_task, mocker):
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    mocked_popen = reboot_task("pre_boot", "00_some_task.sh")
+    reboot_task("post_boot", "README")
+    mocker.patch("rebootmgr.main.validate_task",
+                 side_effect=lambda task: "%s is not executable" % task if task.endswith("README") else None)
+    mocked_lock = mocker.patch("rebootmgr.main.Lock")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert "Invalid task: /etc/rebootmgr/post_boot_tasks/README is not executable" in result.output
+    assert result.exit_code == 105
+    mocked_lock.assert_not_called()
+    mocked_popen.assert_not_called()
+    mocked_run.assert_not_called()
+
+
+def test_invalid_pre_boot_tasks_do_not_block_post_reboot(
+        run_cli, consul_cluster, forward_consul_port, default_config, reboot_task, mocker):
+    hostname = socket.gethostname().split(".")[0]
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", hostname)
+    mocker.patch("time.sleep")
+    mocked_run = mocker.patch("subprocess.run")
+    reboot_task("pre_boot", "README")
+    mocked_popen = reboot_task("post_boot", "50_another_task.sh")
+    mocker.patch("rebootmgr.main.validate_task",
+                 side_effect=lambda task: "%s is not executable" % task if task.endswith("README") else None)
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+    assert "Invalid task" not in result.output
+    mocked_popen.assert_called_once()
+    mocked_run.assert_not_called()
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is None
+
+
+def test_validate_task(tmp_path):
+    script = tmp_path / "00_script.sh"
+    script.write_text("#!/bin/sh\ntrue\n")
+    script.chmod(0o755)
+    readme = tmp_path / "README"
+    readme.write_text("Tasks run before the reboot\n")
+    readme.chmod(0o755)
+    not_executable = tmp_path / "10_script.sh"
+    not_executable.write_text("#!/bin/sh\ntrue\n")
+    broken_link = tmp_path / "20_link.sh"
+    broken_link.symlink_to(tmp_path / "does-not-exist")
+
+    assert validate_task(str(script)) is None
+    assert "has no shebang" in validate_task(str(readme))
+    assert "is not executable" in validate_task(str(not_executable))
+    assert "broken symlink" in validate_task(str(broken_link))
+
+    tasks, problems = discover_tasks(str(tmp_path))
+    assert tasks == [str(script), str(not_executable), str(broken_link), str(readme)]
+    assert len(problems) == 3
+
+
+def test_rollback_tasks_failing_and_timing_out(tmp_path, caplog):
+    rollback_dir = tmp_path / "rollback"
+    rollback_dir.mkdir()
+    pid_file = tmp_path / "pid"
+    scripts = {
+        "00_fails.sh": "#!/bin/sh\nexit 3\n",
+        "10_hangs.sh": "#!/bin/sh\necho $$ > {}\nexec sleep 600\n".format(pid_file),
+        "20_works.sh": "#!/bin/sh\nexit 0\n",
+    }
+    for name, script in scripts.items():
+        path = rollback_dir / name
+        path.write_text(script)
+        path.chmod(0o755)
+
+    # The timeout is in minutes
+    run_rollback_tasks(str(rollback_dir), ["/tasks/00_fails.sh", "/tasks/10_hangs.sh", "/tasks/20_works.sh"], {},
+                       task_timeout=0.02)
+
+    assert "Rollback task {}/00_fails.sh failed with return code 3".format(rollback_dir) in caplog.text
+    assert "Could not finish rollback task {}/10_hangs.sh in 0 minutes".format(rollback_dir) in caplog.text
+    assert "20_works.sh failed" not in caplog.text
+    # The hanging rollback task was terminated
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
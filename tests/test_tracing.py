@@ -0,0 +1,56 @@
+import json
+
+from rebootmgr import tracing
+from rebootmgr.main import cli as rebootmgr
+
+
+def test_trace_file(run_cli, forward_consul_port, default_config, reboot_task, mock_subprocess_run, mocker, tmp_path):
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+    reboot_task("pre_boot", "00_some_task.sh")
+    trace_file = tmp_path / "trace.json"
+
+    result = run_cli(rebootmgr, ["-v", "--trace-file", str(trace_file)])
+
+    assert result.exit_code == 0
+    request = json.loads(trace_file.read_text())
+    spans = request["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert len({s["traceId"] for s in spans}) == 1
+    names = [s["name"] for s in spans]
+    assert "consul.kv.get" in names
+    assert "consul.agent.members" in names
+    assert "consul.health.state" in names
+    root = spans[-1]
+    assert root["name"] == "rebootmgr"
+    assert "parentSpanId" not in root
+    assert {"key": "exit_code", "value": {"intValue": "0"}} in root["attributes"]
+    task = spans[names.index("task")]
+    assert task["parentSpanId"] == root["spanId"]
+    assert {"key": "task", "value": {"stringValue": "/etc/rebootmgr/pre_boot_tasks/00_some_task.sh"}} in task["attributes"]
+
+
+def test_no_trace_file(run_cli, forward_consul_port, default_config, reboot_task, mock_subprocess_run, mocker):
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+    instrument = mocker.spy(tracing, "instrument")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+    con = instrument.spy_return
+    assert not isinstance(con.kv, tracing._TracedEndpoint)
+    assert tracing.span("task") is tracing._NOOP_SPAN
+
+
+def test_trace_file_cannot_be_written(run_cli, forward_consul_port, default_config, reboot_task, mock_subprocess_run,
+                                      mocker, tmp_path):
+    mocker.patch("time.sleep")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+    trace_file = tmp_path / "missing" / "trace.json"
+
+    result = run_cli(rebootmgr, ["-v", "--trace-file", str(trace_file)])
+
+    # The run is not affected
+    assert result.exit_code == 0
+    assert "Could not write trace to {}".format(trace_file) in result.output
+    assert tracing.span("task") is tracing._NOOP_SPAN
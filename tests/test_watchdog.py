@@ -0,0 +1,179 @@
+import json
+import time
+
+import consul
+import pytest
+from consul_lib import Lock
+
+from rebootmgr.main import cli as rebootmgr
+
+
+def reboot_record(host, minutes_ago, expected_duration=3600):
+    started = time.time() - minutes_ago * 60
+    return json.dumps({"host": host, "boot_id": "some-boot-id", "phase": "rebooting",
+                       "started": started, "updated": started,
+                       "expected_duration": expected_duration, "session": None})
+
+
+@pytest.fixture
+def cleanup_kv(consul_cluster):
+    yield
+    consul_cluster[0].kv.delete("service/rebootmgr", recurse=True)
+
+
+def test_watchdog_reclaims_reboot_of_dead_node(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", reboot_record("ceph-1", 120))
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/ceph-1/config", '{"enabled": true, "group": "ceph"}')
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/ceph_reboot_in_progress")
+    assert data is None
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/nodes/ceph-1/config")
+    config = json.loads(data["Value"].decode())
+    assert config["enabled"] is False
+    assert "Reboot of ceph-1 started at" in config["message"]
+    mocked_fire.assert_called_once()
+    assert "(ceph-1) (ceph)" in mocked_fire.call_args[0][1]
+
+
+def test_watchdog_survives_invalid_expected_duration(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/compute_reboot_in_progress", reboot_record("compute-1", 10, "3600"))
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", reboot_record("ceph-1", 120))
+    mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    assert "Reboot of compute-1 has an invalid expected duration '3600', assuming 60 minutes" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/compute_reboot_in_progress")
+    assert data is not None
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/ceph_reboot_in_progress")
+    assert data is None
+
+
+def test_watchdog_continues_after_error(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/compute_reboot_in_progress", '{"host": "compute-1", "started": "x"}')
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", reboot_record("ceph-1", 120))
+    mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    assert "Could not watch the reboot of group compute" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/ceph_reboot_in_progress")
+    assert data is None
+
+
+def test_watchdog_keeps_reboot_slot_if_node_cannot_be_disabled(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", reboot_record("ceph-1", 120))
+    mocker.patch("rebootmgr.main.update_config", side_effect=RuntimeError("Too many concurrent updates"))
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    assert "Could not disable ceph-1, keeping its reboot slot" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/ceph_reboot_in_progress")
+    assert data is not None
+    mocked_fire.assert_not_called()
+
+
+def test_watchdog_runs_once_per_datacenter(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", reboot_record("ceph-1", 120))
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+    other_watchdog = Lock(consul_cluster[1], "service/rebootmgr/watchdog", checks=[])
+    assert other_watchdog.acquire(blocking=False)
+
+    try:
+        result = run_cli(rebootmgr, ["-v", "--watchdog"])
+    finally:
+        other_watchdog.release()
+
+    assert result.exit_code == 0
+    assert "Another watchdog is running" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/ceph_reboot_in_progress")
+    assert data is not None
+    mocked_fire.assert_not_called()
+
+
+def test_watchdog_escalates_stuck_reboot_of_alive_node(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", reboot_record("consul2", 90, 1800))
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    assert "Reboot of consul2 is stuck in phase rebooting for 90 minutes" in result.output
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is not None
+    mocked_fire.assert_called_once()
+    assert "minutes" not in mocked_fire.call_args[0][1]
+
+    # The next run, on any node, escalates the same stuck reboot again, which is deduplicated
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    mocked_fire.assert_called_once()
+
+
+@pytest.mark.parametrize("args,minutes_ago", [(["--dryrun"], 120), ([], 10)])
+def test_watchdog_leaves_reboot_alone(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker,
+        args, minutes_ago):
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", reboot_record("ceph-1", minutes_ago))
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"] + args)
+
+    assert result.exit_code == 0
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/reboot_in_progress")
+    assert data is not None
+    mocked_fire.assert_not_called()
+
+
+def test_watchdog_without_reboots_does_not_write(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    create = mocker.spy(consul.Consul.Session, "create")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    assert "No reboot in progress" in result.output
+    create.assert_not_called()
+
+
+def test_watchdog_destroys_its_session(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/reboot_in_progress", reboot_record("ceph-1", 10))
+    create = mocker.spy(consul.Consul.Session, "create")
+    destroy = mocker.spy(consul.Consul.Session, "destroy")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    destroy.assert_called_once_with(mocker.ANY, create.spy_return)
+
+
+def test_watchdog_escalates_if_reboot_slot_changed(
+        run_cli, forward_consul_port, consul_cluster, cleanup_kv, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/ceph_reboot_in_progress", reboot_record("ceph-1", 120))
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/ceph-1/config", '{"enabled": true, "group": "ceph"}')
+    mocker.patch("consul.Consul.KV.delete", return_value=False)
+    mocked_fire = mocker.patch("consul.Consul.Event.fire")
+
+    result = run_cli(rebootmgr, ["-v", "--watchdog"])
+
+    assert result.exit_code == 0
+    mocked_fire.assert_called_once()
+    assert "changed in the meantime and was kept" in mocked_fire.call_args[0][1]
+    _, data = consul_cluster[0].kv.get("service/rebootmgr/nodes/ceph-1/config")
+    assert json.loads(data["Value"].decode())["enabled"] is False
@@ -1,5 +1,8 @@
+import json
+import pytest
 import time
 
+import rebootmgr.main as rebootmgr_main
 from rebootmgr.main import cli as rebootmgr
 from consul import Check
 
@@ -122,3 +125,86 @@ def test_reboot_succeeds_with_failing_consul_cluster_if_ignored(
 
 # TODO(oseibert): Test cases where consul service checks succeed/fail after the
 #  (2 * 60) + 10 seconds sleeping time, when they are done the second time.
+
+
+@pytest.mark.parametrize("entry", [
+    "consul2",
+    "consul[23]",
+    "re:consul[0-9]+",
+    {"host": "consul2"},
+    {"host": "consul*", "expires": "2999-01-01T00:00:00"},
+])
+def test_reboot_succeeds_with_failing_consul_cluster_if_whitelisted_pattern(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mock_subprocess_run, mocker, entry):
+    consul_cluster[0].kv.put("service/rebootmgr/ignore_failed_checks", json.dumps([entry]))
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.Popen")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+
+    def newmembers(self):
+        return [
+            {'Status': 1, 'Name': 'consul1'},
+            {'Status': 0, 'Name': 'consul2'},
+        ]
+
+    mocker.patch("consul.base.Consul.Agent.members", new=newmembers)
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+
+
+def test_reboot_succeeds_with_failing_checks_if_group_whitelisted(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mock_subprocess_run, mocker):
+    consul_cluster[0].kv.put("service/rebootmgr/nodes/consul2/config", '{"enabled": true, "group": "storage"}')
+    consul_cluster[0].kv.put("service/rebootmgr/ignore_failed_checks", '["group:storage"]')
+
+    consul_cluster[0].agent.service.register("A", tags=["rebootmgr"])
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr"],
+                                             check=Check.ttl("1ms"))  # Failing
+    time.sleep(0.01)
+
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.Popen")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+
+
+@pytest.mark.parametrize("expires", ["2000-01-01T00:00:00", 946681200, "next tuesday"])
+def test_reboot_fails_with_failing_checks_if_whitelist_entry_expired(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mock_subprocess_run, mocker, expires):
+    consul_cluster[0].kv.put("service/rebootmgr/ignore_failed_checks",
+                             json.dumps([{"host": "consul2", "expires": expires}]))
+
+    consul_cluster[0].agent.service.register("A", tags=["rebootmgr"])
+    consul_cluster[1].agent.service.register("A", tags=["rebootmgr"],
+                                             check=Check.ttl("1ms"))  # Failing
+    time.sleep(0.01)
+
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.Popen")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 2
+
+
+def test_whitelist_is_read_once_per_run(
+        run_cli, consul_cluster, forward_consul_port, default_config,
+        reboot_task, mock_subprocess_run, mocker):
+    mocker.patch("time.sleep")
+    mocker.patch("subprocess.Popen")
+    mock_subprocess_run(["shutdown", "-r", "+1"])
+    spy = mocker.spy(rebootmgr_main, "get_whitelist")
+
+    result = run_cli(rebootmgr, ["-v"])
+
+    assert result.exit_code == 0
+    assert spy.call_count == 1